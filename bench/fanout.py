@@ -0,0 +1,147 @@
+#!/usr/bin/python3
+
+"""
+clashd fan-out benchmark: one master streams output frames to 1, 10 and 100
+viewers of the same session, with the server running in-process.
+
+    PYTHONPATH=. python3 bench/fanout.py --messages 2000 --size 1024
+"""
+
+import asyncio
+import json
+import statistics
+import struct
+import time
+
+import aiohttp
+import click
+from aiohttp import web
+
+from clash.protocol import PROTOCOL_VERSION, FRAME_OUTPUT, encode_frame, decode_frame
+from clash.server import ClashServer
+
+STAMP = struct.Struct("!Id")  # message number, send time
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+async def viewer(session, url, received, count, delay):
+    ws = await session.ws_connect(url, params={"protocol": PROTOCOL_VERSION})
+    ready = asyncio.get_event_loop().create_future()
+
+    async def reader():
+        # a viewer that falls behind gets a snapshot instead of the frames clashd dropped
+        while True:
+            msg = await ws.receive()
+            if msg.type == aiohttp.WSMsgType.TEXT:
+                data = json.loads(msg.data)
+                if "protocol" in data:
+                    ready.set_result(True)
+                elif "sync" in data and data["sync"].get("last", -1) == count - 1:
+                    break
+                continue
+            if msg.type != aiohttp.WSMsgType.BINARY:
+                break
+            now = time.perf_counter()
+            _, _, _, _, payload = decode_frame(msg.data)
+            number, _ = STAMP.unpack_from(payload)
+            received[number] = max(received.get(number, 0), now)
+            if number == count - 1:
+                break
+            if delay:
+                await asyncio.sleep(delay)
+        await ws.close()
+
+    task = asyncio.create_task(reader())
+    await ready
+    return task
+
+
+async def answer_resyncs(master, sent):
+    async for msg in master:
+        if msg.type != aiohttp.WSMsgType.TEXT:
+            continue
+        data = json.loads(msg.data)
+        if "resync" in data:
+            snapshot = {"sync": {"last": len(sent) - 1}, "header": {"to": data["header"]["from"]}}
+            await master.send_str(json.dumps(snapshot))
+
+
+async def run(server, port, viewers, messages, size, slow):
+    url = f"http://localhost:{port}/clash"
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        master = await session.ws_connect(url, params={"protocol": PROTOCOL_VERSION})
+        session_id = (await master.receive_json())["session"]
+
+        received = {}  # latest arrival per message over all viewers, except the slow one
+        tasks = []
+        for i in range(viewers):
+            delay = slow if i == 0 else 0
+            arrivals = {} if delay else received
+            tasks.append(await viewer(session, f"{url}/{session_id}", arrivals, messages, delay))
+
+        slaves = list(server.sessions[session_id].slaves.values())
+        sent = {}
+        answer = asyncio.create_task(answer_resyncs(master, sent))
+        padding = b"x" * max(0, size - STAMP.size)
+        start = time.perf_counter()
+        for number in range(messages):
+            sent[number] = time.perf_counter()
+            await master.send_bytes(encode_frame(FRAME_OUTPUT, STAMP.pack(number, sent[number]) + padding, seq=number))
+            if number % 64 == 0:
+                await asyncio.sleep(0)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        dropped = sum(slave.dropped for slave in slaves)
+        resyncs = sum(slave.resyncs for slave in slaves)
+        answer.cancel()
+        await master.close()
+
+    if not received:  # only the slow viewer
+        return {"viewers": viewers, "dropped": dropped, "resyncs": resyncs}
+    latencies = [(received[n] - sent[n]) * 1000 for n in received]
+    return {"viewers": viewers,
+            "messages": messages,
+            "size": size,
+            "seconds": round(elapsed, 3),
+            "messages_per_sec": round(messages / elapsed),
+            "deliveries_per_sec": round(messages * viewers / elapsed),
+            "latency_ms_p50": round(percentile(latencies, 50), 3),
+            "latency_ms_p99": round(percentile(latencies, 99), 3),
+            "latency_ms_mean": round(statistics.mean(latencies), 3),
+            "dropped": dropped,
+            "resyncs": resyncs}
+
+
+async def bench(port, viewers, messages, size, slow):
+    server = ClashServer()
+    runner = web.AppRunner(server.app)
+    await runner.setup()
+    site = web.TCPSite(runner, "localhost", port)
+    await site.start()
+    results = []
+    try:
+        for count in viewers:
+            results.append(await run(server, port, count, messages, size, slow))
+    finally:
+        await runner.cleanup()
+    return results
+
+
+@click.command()
+@click.option('--port', default=18080, help='port for the in-process clashd')
+@click.option('--viewers', '-v', default="1,10,100", help='comma separated viewer counts')
+@click.option('--messages', '-n', default=2000, help='output frames per run')
+@click.option('--size', '-s', default=1024, help='payload bytes per frame')
+@click.option('--slow', default=0.0, help='per message delay of the first viewer in seconds, it is left out of the latencies')
+def main(port, viewers, messages, size, slow):
+    counts = [int(v) for v in viewers.split(",")]
+    for result in asyncio.run(bench(port, counts, messages, size, slow)):
+        print(json.dumps(result))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,279 @@
+#!/usr/bin/python3
+
+"""
+clashd load benchmark: N synthetic masters stream PTY output to M viewers
+each, reporting throughput, fan-out latency and clashd's CPU and memory as
+one JSON line per run.
+
+    PYTHONPATH=. python3 bench/load.py --sessions 1,10,50 --viewers 10 --duration 10
+    PYTHONPATH=. python3 bench/load.py --trace typescript            # replay recorded PTY output
+    PYTHONPATH=. python3 bench/load.py --url http://host:8080/clash --pid 1234
+    PYTHONPATH=. python3 bench/load.py --workers 4                    # clashd --workers 4
+
+clashd is started as a subprocess by default so CPU and RSS are its own,
+--in-process runs it inside the benchmark (numbers then include the load
+generator), --url uses a running clashd (--pid to get its CPU and RSS). CPU and RSS
+include the process' children, the workers of a multi-process clashd.
+"""
+
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import aiohttp
+import click
+import psutil
+from aiohttp import web
+
+import clash
+from clash.protocol import PROTOCOL_VERSION, FRAME_OUTPUT, FRAME_RESIZE, RESIZE, encode_frame, decode_frame
+from clash.server import ClashServer
+
+COLS = 120
+ROWS = 40
+GRACE = 5            # seconds to wait for viewers to catch up after the masters finished
+SAMPLE_INTERVAL = 0.25  # seconds between RSS samples
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def synthetic_traffic(size):
+    """colored listings, plain text and cursor movement, roughly like a busy shell"""
+    lines = []
+    for i in range(400):
+        if i % 3 == 0:
+            lines.append(f"\x1b[01;34mdirectory-{i}\x1b[0m  \x1b[01;32mscript-{i}.sh\x1b[0m  "
+                         f"file-{i}.txt  \x1b[31marchive-{i}.tar\x1b[0m")
+        elif i % 3 == 1:
+            lines.append(f"{i:5d}  the quick brown fox jumps over the lazy dog, line {i} of the build log")
+        else:
+            lines.append(f"\x1b[1A\x1b[2K\x1b[1;33mprogress\x1b[m [{'#' * (i % 50):50s}] {i % 100}%")
+    data = ("\r\n".join(lines) + "\r\n").encode()
+    return data
+
+
+def chunks(data, size):
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+async def master(session, url, traffic, rate, duration, sent, ready, go):
+    ws = await session.ws_connect(url, params={"protocol": PROTOCOL_VERSION})
+    session_id = (await ws.receive_json())["session"]
+    await ws.send_str(json.dumps({"host": "bench"}))
+    await ws.send_bytes(encode_frame(FRAME_RESIZE, RESIZE.pack(COLS + 1, ROWS + 1), seq=1))
+    ready.set_result(session_id)
+
+    async def drain():  # joins, resyncs
+        async for msg in ws:
+            pass
+    reader = asyncio.create_task(drain())
+
+    await go.wait()
+    interval = 1 / rate
+    start = time.perf_counter()
+    seq = 1
+    while time.perf_counter() - start < duration:
+        for chunk in traffic:
+            seq += 1
+            sent[seq] = time.perf_counter()
+            await ws.send_bytes(encode_frame(FRAME_OUTPUT, chunk, seq=seq))
+            delay = start + (seq - 1) * interval - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if time.perf_counter() - start >= duration:
+                break
+    return ws, reader, seq
+
+
+async def viewer(session, url, sent, latencies, received, done):
+    ws = await session.ws_connect(url, params={"protocol": PROTOCOL_VERSION})
+    await ws.send_str(json.dumps({"join": "bench"}))
+    async for msg in ws:
+        if msg.type != aiohttp.WSMsgType.BINARY:
+            continue
+        now = time.perf_counter()
+        frame_type, _, _, seq, payload = decode_frame(msg.data)
+        if frame_type != FRAME_OUTPUT:
+            continue
+        latencies.append(now - sent[seq])
+        received[0] += 1
+        received[1] += len(payload)
+        if done.get("last") == seq:
+            break
+    await ws.close()
+
+
+def processes(process):
+    return [process] + process.children(recursive=True)
+
+
+def cpu_seconds(process):
+    return sum(p.cpu_times().user + p.cpu_times().system for p in processes(process))
+
+
+def rss(process):
+    return sum(p.memory_info().rss for p in processes(process))
+
+
+async def sample_rss(process, peak):
+    while True:
+        peak[0] = max(peak[0], rss(process))
+        await asyncio.sleep(SAMPLE_INTERVAL)
+
+
+async def run(url, process, sessions, viewers, rate, duration, traffic):
+    latencies = []
+    received = [0, 0]  # messages, bytes
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=0)) as session:
+        masters = []
+        tasks = []
+        go = asyncio.Event()
+        for _ in range(sessions):
+            sent = {}
+            done = {}
+            ready = asyncio.get_event_loop().create_future()
+            masters.append((asyncio.create_task(master(session, url, traffic, rate, duration, sent, ready, go)), done))
+            session_id = await ready
+            for _ in range(viewers):
+                tasks.append(asyncio.create_task(viewer(session, f"{url}/{session_id}", sent, latencies, received, done)))
+
+        await asyncio.sleep(1)  # let the viewers join
+        peak = [0]
+        sampler = asyncio.create_task(sample_rss(process, peak)) if process else None
+        cpu = cpu_seconds(process) if process else None
+        start = time.perf_counter()
+        go.set()
+
+        sent_total = 0
+        results = []
+        for task, done in masters:
+            ws, reader, last = await task
+            done["last"] = last
+            sent_total += last - 1
+            results.append((ws, reader))
+        elapsed = time.perf_counter() - start
+        await asyncio.wait(tasks, timeout=GRACE)
+        if process:
+            cpu_end = cpu_seconds(process)
+            sampler.cancel()
+        for ws, reader in results:
+            reader.cancel()
+            await ws.close()
+        for task in tasks:
+            task.cancel()
+
+    result = {"version": clash.__VERSION__,
+              "sessions": sessions,
+              "viewers": viewers,
+              "rate": rate,
+              "seconds": round(elapsed, 3),
+              "messages_sent": sent_total,
+              "deliveries": received[0],
+              "lost": sent_total * viewers - received[0],
+              "deliveries_per_sec": round(received[0] / elapsed),
+              "mb_delivered_per_sec": round(received[1] / elapsed / 1e6, 3)}
+    if latencies:
+        latencies = [latency * 1000 for latency in latencies]
+        result.update({"latency_ms_p50": round(percentile(latencies, 50), 3),
+                       "latency_ms_p90": round(percentile(latencies, 90), 3),
+                       "latency_ms_p99": round(percentile(latencies, 99), 3),
+                       "latency_ms_max": round(max(latencies), 3)})
+    if process:
+        result.update({"cpu_percent": round(100 * (cpu_end - cpu) / elapsed, 1),
+                       "rss_mb": round(rss(process) / 1e6, 1),
+                       "rss_peak_mb": round(peak[0] / 1e6, 1)})
+    return result
+
+
+def wait_for_port(port, timeout=10):
+    start = time.monotonic()
+    while time.monotonic() - start < timeout:
+        try:
+            socket.create_connection(("localhost", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise click.ClickException(f"clashd did not come up on port {port}")
+
+
+async def bench(url, process, sessions, viewers, rate, duration, traffic, in_process, port, workers):
+    runner = None
+    if in_process:
+        runner = web.AppRunner(ClashServer().app)
+        await runner.setup()
+        await web.TCPSite(runner, "localhost", port).start()
+    results = []
+    try:
+        for count in sessions:
+            result = await run(url, process, count, viewers, rate, duration, traffic)
+            result["server"] = "in-process" if in_process else "external" if process is None else "subprocess"
+            if result["server"] == "subprocess":
+                result["workers"] = workers
+            results.append(result)
+            print(json.dumps(result), flush=True)
+    finally:
+        if runner:
+            await runner.cleanup()
+    return results
+
+
+@click.command()
+@click.option('--sessions', '-s', default="1,10,50", help='comma separated numbers of masters')
+@click.option('--viewers', '-v', default=10, help='viewers per session')
+@click.option('--rate', '-r', default=100, help='output chunks per second and master')
+@click.option('--size', default=512, help='bytes per output chunk')
+@click.option('--duration', '-d', default=10.0, help='seconds each master streams')
+@click.option('--trace', type=click.Path(exists=True), help='recorded PTY output to replay instead of synthetic traffic')
+@click.option('--port', default=18081, help='port for the clashd started by the benchmark')
+@click.option('--workers', '-w', default=1, help='worker processes of the clashd started by the benchmark')
+@click.option('--in-process', is_flag=True, help='run clashd inside the benchmark process')
+@click.option('--url', help='use a running clashd, e.g. http://localhost:8080/clash')
+@click.option('--pid', type=int, help='process id of the running clashd, for CPU and RSS')
+@click.option('--output', '-o', type=click.File('a'), help='also append the results to this file')
+def main(sessions, viewers, rate, size, duration, trace, port, workers, in_process, url, pid, output):
+    counts = [int(s) for s in sessions.split(",")]
+    if trace:
+        with open(trace, "rb") as f:
+            data = f.read()
+    else:
+        data = synthetic_traffic(size)
+    traffic = chunks(data, size)
+
+    server = None
+    process = None
+    if url:
+        if pid:
+            process = psutil.Process(pid)
+    elif in_process:
+        url = f"http://localhost:{port}/clash"
+        process = psutil.Process()
+    else:
+        url = f"http://localhost:{port}/clash"
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=root)
+        command = f"from clash.server import ClashServer; ClashServer().run(port={port}, workers={workers})"
+        server = subprocess.Popen([sys.executable, "-c", command],
+                                  env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        wait_for_port(port)
+        process = psutil.Process(server.pid)
+
+    try:
+        results = asyncio.run(bench(url, process, counts, viewers, rate, duration, traffic, in_process, port, workers))
+    finally:
+        if server:
+            server.terminate()
+            server.wait()
+    if output:
+        for result in results:
+            output.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+#!/usr/bin/python3
+
+"""
+Terminal emulation benchmark: replays PTY output through a headless
+ClashTerminal and reports bytes/s, escape sequences/s and memory per
+workload, one JSON line each. The final screen of every workload is
+checked against the golden snapshots in terminal.golden.json, so a
+speedup that changes the emulation fails the run.
+
+    PYTHONPATH=. python3 bench/terminal.py
+    PYTHONPATH=. python3 bench/terminal.py --workload vim --workload ls
+    PYTHONPATH=. python3 bench/terminal.py --trace typescript   # recorded output, e.g. from script(1)
+    PYTHONPATH=. python3 bench/terminal.py --update             # after intended emulation changes
+
+The built-in workloads are generated, deterministic streams shaped like
+the traffic of the programs they are named after.
+"""
+
+import hashlib
+import json
+import os
+import random
+import struct
+import time
+import tracemalloc
+
+import click
+
+from clash.terminal import ClashTerminal
+
+COLS = 120
+ROWS = 40
+GOLDEN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "terminal.golden.json")
+
+WORDS = ("alpha", "beta", "gamma", "delta", "clash", "shell", "terminal", "session", "output", "buffer",
+         "screen", "cursor", "scroll", "region", "escape", "sequence", "the", "a", "of", "and", "ünïcödé", "🐧")
+
+
+def nolog(_):
+    pass
+
+
+def text_line(rng, width=100):
+    words = []
+    length = 0
+    while length < width:
+        word = rng.choice(WORDS)
+        words.append(word)
+        length += len(word) + 1
+    return " ".join(words)[:width]
+
+
+def workload_cat(rng):
+    """large plain text file"""
+    return "".join(text_line(rng, rng.randint(20, 119)) + "\r\n" for _ in range(20000)).encode()
+
+
+def workload_ls(rng):
+    """colored directory listings"""
+    colors = ("01;34", "01;32", "01;36", "31", "01;35", "00")
+    lines = []
+    for _ in range(15000):
+        entries = [f"\x1b[{rng.choice(colors)}m{rng.choice(WORDS)}-{rng.randint(0, 999)}\x1b[0m"
+                   for _ in range(rng.randint(1, 6))]
+        lines.append("  ".join(entries))
+    return ("\r\n".join(lines) + "\r\n").encode()
+
+
+def workload_vim(rng):
+    """scrolling a syntax highlighted file: scroll region, new line at the bottom, status line"""
+    out = ["\x1b[?1049h\x1b[H\x1b[2J"]
+    for row in range(ROWS - 1):
+        out.append(f"\x1b[{row + 1};1H\x1b[38;5;{rng.randint(1, 255)}m{text_line(rng, 80)}\x1b[m")
+    for step in range(5000):
+        out.append("\x1b[?25l")
+        out.append(f"\x1b[1;{ROWS - 1}r\x1b[{ROWS - 1};1H\r\n\x1b[r")
+        out.append(f"\x1b[{ROWS - 1};1H\x1b[33m{step:5d} \x1b[m")
+        for _ in range(rng.randint(1, 4)):
+            out.append(f"\x1b[38;5;{rng.randint(1, 255)}m{rng.choice(WORDS)}\x1b[m ")
+        out.append(f"\x1b[{ROWS};1H\x1b[7mfile.py\x1b[m\x1b[K"
+                   f"\x1b[{ROWS};{COLS - 20}H{step},1\x1b[{ROWS};{COLS - 6}H{step % 100}%")
+        out.append(f"\x1b[{ROWS - 1};1H\x1b[?25h")
+    out.append("\x1b[?1049l")
+    return "".join(out).encode()
+
+
+def workload_htop(rng):
+    """full screen refreshes with meters, bars and process rows"""
+    out = ["\x1b[H\x1b[2J"]
+    for _ in range(400):
+        for cpu in range(4):
+            usage = rng.randint(0, 40)
+            out.append(f"\x1b[{cpu + 1};3H\x1b[1m{cpu}\x1b[m[\x1b[32m{'|' * usage}\x1b[31m{'|' * (usage // 4)}"
+                       f"\x1b[m{' ' * (50 - usage - usage // 4)}\x1b[1m{usage * 2.5:5.1f}%\x1b[m]")
+        out.append(f"\x1b[6;1H\x1b[30;46m  PID USER      PRI  NI  VIRT   RES   SHR S CPU% MEM%   TIME+  Command{' ' * 47}\x1b[m")
+        for row in range(7, ROWS + 1):
+            out.append(f"\x1b[{row};1H{rng.randint(1, 99999):5d} \x1b[36m{rng.choice(WORDS)[:8]:8s}\x1b[m  20   0 "
+                       f"{rng.randint(1, 999):4d}M {rng.randint(1, 999):4d}M  \x1b[1;32m{rng.random() * 10:4.1f}\x1b[m "
+                       f"{rng.choice(WORDS)}\x1b[K")
+    return "".join(out).encode()
+
+
+def workload_scroll_region(rng):
+    """tmux like: a scroll region between fixed bars, scrolled both ways"""
+    out = ["\x1b[H\x1b[2J", f"\x1b[1;1H\x1b[44m{' ' * COLS}\x1b[m", f"\x1b[5;{ROWS - 4}r"]
+    for step in range(8000):
+        if step % 10 < 7:
+            out.append(f"\x1b[{ROWS - 4};1H\n\x1b[{ROWS - 4};1H\x1b[32m{step}\x1b[m {text_line(rng, 60)}")
+        else:
+            out.append(f"\x1b[5;1H\x1bM\x1b[5;1H\x1b[35m{step}\x1b[m {text_line(rng, 40)}")
+        if step % 25 == 0:
+            out.append(f"\x1b7\x1b[{ROWS};1H\x1b[7m[{step}] 0:bash* 1:vim\x1b[m\x1b[K\x1b8")
+    out.append("\x1b[r")
+    return "".join(out).encode()
+
+
+WORKLOADS = {"cat": workload_cat,
+             "ls": workload_ls,
+             "vim": workload_vim,
+             "htop": workload_htop,
+             "scroll-region": workload_scroll_region}
+
+
+def feed(data, chunk):
+    terminal = ClashTerminal(log=nolog)
+    terminal.start(COLS, ROWS, headless=True)
+    for i in range(0, len(data), chunk):
+        terminal.input(data[i:i + chunk])
+    return terminal
+
+
+def fingerprint(terminal):
+    """hash of the screen content, size and cursor, independent of the dump() format"""
+    screen = terminal.buffer
+    digest = hashlib.sha256(struct.pack("!HHHH", screen.cols, screen.rows, terminal.col, terminal.row))
+    for chars, attrs in zip(screen.chars, screen.attrs):
+        digest.update(chars.tobytes())
+        digest.update(attrs.tobytes())
+    return digest.hexdigest()
+
+
+def measure(name, data, chunk, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        terminal = feed(data, chunk)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # separate pass, tracing slows things down
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    traced = feed(data, chunk)
+    _, peak = tracemalloc.get_traced_memory()
+    retained = tracemalloc.take_snapshot().compare_to(before, "filename")
+    tracemalloc.stop()
+    del traced
+
+    escapes = data.count(b"\x1b")
+    return {"workload": name,
+            "bytes": len(data),
+            "escapes": escapes,
+            "seconds": round(best, 4),
+            "mb_per_sec": round(len(data) / best / 1e6, 3),
+            "escapes_per_sec": round(escapes / best),
+            "peak_kb": round(peak / 1024),
+            "retained_kb": round(sum(stat.size_diff for stat in retained) / 1024),
+            "retained_blocks": sum(stat.count_diff for stat in retained),
+            "screen": fingerprint(terminal)}
+
+
+@click.command()
+@click.option('--workload', '-w', multiple=True, type=click.Choice(list(WORKLOADS)),
+              help='built-in workloads to run, all by default')
+@click.option('--trace', '-t', multiple=True, type=click.Path(exists=True), help='recorded PTY output to replay as well')
+@click.option('--chunk', default=4096, help='bytes per input() call, like PTY reads')
+@click.option('--repeat', '-n', default=3, help='runs per workload, the fastest counts')
+@click.option('--update', is_flag=True, help='store the final screens as the new golden snapshots')
+def main(workload, trace, chunk, repeat, update):
+    workloads = [(name, WORKLOADS[name](random.Random(name))) for name in (workload or WORKLOADS)]
+    for path in trace:
+        with open(path, "rb") as f:
+            workloads.append((os.path.basename(path), f.read()))
+
+    golden = {}
+    if os.path.exists(GOLDEN):
+        with open(GOLDEN) as f:
+            golden = json.load(f)
+
+    failed = []
+    for name, data in workloads:
+        result = measure(name, data, chunk, repeat)
+        expected = golden.get(name)
+        if update:
+            golden[name] = result["screen"]
+        elif expected is None:
+            result["golden"] = "missing"
+        else:
+            result["golden"] = "ok" if expected == result["screen"] else "MISMATCH"
+            if expected != result["screen"]:
+                failed.append(name)
+        print(json.dumps(result), flush=True)
+
+    if update:
+        with open(GOLDEN, "w") as f:
+            json.dump(golden, f, indent=4, sort_keys=True)
+            f.write("\n")
+    if failed:
+        raise click.ClickException(f"final screen differs from the golden snapshot: {', '.join(failed)}")
+
+
+if __name__ == "__main__":
+    main()
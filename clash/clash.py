@@ -8,6 +8,7 @@ import setproctitle
 
 from .master import ClashMaster
 from .slave import ClashSlave
+from .recording import ClashPlayer
 
 global logfile
 logfile = None
@@ -26,8 +27,16 @@ def nolog(_):
 
 @click.command()
 @click.option('--debug', '-d', is_flag=True, help='debug')
+@click.option('--fps', default=60, help='maximum screen refresh rate, 0 to refresh once per event loop iteration')
+@click.option('--scrollback', default=10000, help='lines of history kept for scroll mode (Ctrl-A [)')
+@click.option('--input-window', default=3, help='ms keystrokes are collected for before they are sent, 0 sends every read')
+@click.option('--state-sync', is_flag=True, help='get screen updates instead of all output, for slow links')
+@click.option('--latency', is_flag=True, help='measure keystroke to echo latency, shown in the border and logged with --debug')
+@click.option('--record', '-r', type=click.Path(), help='record the session to this file, replay with: clash play FILE')
+@click.option('--seek', default=0.0, help='clash play: start at this many seconds into the recording')
 @click.argument('session', required=False)
-def main(debug, session):
+@click.argument('recording', required=False)
+def main(debug, fps, scrollback, input_window, state_sync, latency, record, seek, session, recording):
     global logfile
     loop = asyncio.get_event_loop()
     url = "http://localhost:8080/clash"
@@ -47,18 +56,27 @@ def main(debug, session):
     logger = nolog
     if debug:
         logger = log
-        if session:
+        if session == "play":
+            logfile = open("log-play.txt", "w+")
+        elif session:
             logfile = open("log-slave.txt", "w+")
         else:
             logfile = open("log-master.txt", "w+")
 
-    if session:
+    if session == "play":
+        if not recording:
+            print("usage: clash play FILE")
+            sys.exit(1)
+        player = ClashPlayer(recording, log=logger, fps=fps)
+        loop.run_until_complete(player.run(seek))
+    elif session:
         setproctitle.setproctitle("clash")  # hide session id
-        slave = ClashSlave(log=logger, url=url)
+        slave = ClashSlave(log=logger, url=url, fps=fps, scrollback=scrollback, latency=latency,
+                           input_window=input_window, state_sync=state_sync)
         loop.run_until_complete(slave.run(session))
     else:
         setproctitle.setproctitle("clash")
-        master = ClashMaster(log=logger, url=url)
+        master = ClashMaster(log=logger, url=url, fps=fps, scrollback=scrollback, record=record)
         loop.run_until_complete(master.run())
 
 
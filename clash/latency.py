@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+
+from collections import deque
+
+WINDOW = 256  # samples the percentiles are taken over
+
+
+class ClashLatency:
+    """
+    Rolling keystroke-to-echo round trip times of a slave, in ms, with the time
+    spent behind clashd (clashd -> master -> clashd) and in the master (input
+    written to the shell until its output went out) for each sample.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+
+    def add(self, total, server=None, master=None):
+        self.samples.append((total, server, master))
+        self.count += 1
+
+    def percentile(self, p, index=0):
+        values = sorted(sample[index] for sample in self.samples if sample[index] is not None)
+        if not values:
+            return None
+        return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+    def status(self):
+        if not self.samples:
+            return ""
+        return f" ⏱ {self.percentile(50):.0f}/{self.percentile(99):.0f}ms "
+
+    def histogram(self, index=0):
+        """sample counts per power of two bucket: {upper bound in ms: count}"""
+        buckets = {}
+        for sample in self.samples:
+            value = sample[index]
+            if value is None:
+                continue
+            bound = 1
+            while bound < value:
+                bound *= 2
+            buckets[bound] = buckets.get(bound, 0) + 1
+        return dict(sorted(buckets.items()))
+
+    def report(self):
+        lines = []
+        for index, name in enumerate(("total", "clashd", "master")):
+            p50 = self.percentile(50, index)
+            if p50 is None:
+                continue
+            buckets = " ".join(f"<{bound}ms:{count}" for bound, count in self.histogram(index).items())
+            lines.append(f"latency {name}: n={len(self.samples)} p50={p50:.1f} p99={self.percentile(99, index):.1f} {buckets}")
+        return lines
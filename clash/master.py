@@ -7,31 +7,53 @@ import asyncio
 import aiohttp
 import signal
 import functools
+import time
 import traceback
 
 from .terminal import ClashTerminal
 from .shell import ClashShell
 from .stdin import ClashStdin
+from .recording import ClashRecorder
+from .protocol import PROTOCOL_VERSION, FRAME_OUTPUT, FRAME_INPUT, FRAME_RESIZE, RESIZE, encode_frame, decode_frame
+
+FAST_FORWARD_RATE = 256 * 1024  # bytes/s of PTY output above which viewers get snapshots instead of bytes
+FAST_FORWARD_WINDOW = 0.1       # seconds over which the output rate is measured
+FAST_FORWARD_INTERVAL = 0.5     # seconds between snapshots while fast forwarding
+FAST_FORWARD_FPS = 4            # local refresh rate while fast forwarding
 
 
 class ClashMaster:
 
-    def __init__(self, log=None, url="http://localhost:8080/clash"):
+    def __init__(self, log=None, url="http://localhost:8080/clash", fps=60, scrollback=0, record=None):
         self.log = log
         self.url = url
         self.up = True
         self.shell = ClashShell(log=log)
-        self.terminal = ClashTerminal(log=log, shell_input=self.shell.write)
+        self.terminal = ClashTerminal(log=log, shell_input=self.shell.write, fps=fps, scrollback=scrollback)
         self.stdin = ClashStdin(log=log)
         self.sigqueue = asyncio.Queue()
         self.host = os.environ.get('USER', "nobody")
         self.members = {}
+        self.binary = False  # binary frames for terminal I/O, negotiated with clashd
+        self.seq = 0  # numbers output and resize frames and snapshots, so viewers can resume after reconnects
+        self.fps = fps
+        self.fast_forward = False
+        self.fast_forward_task = None
+        self.legacy = set()  # ids of members that cannot load syncs, no fast forward while they watch
+        self.output_bytes = 0
+        self.output_window_bytes = 0
+        self.output_window_start = 0
+        self.traces = []  # (slave id, trace id, arrival) of traced keystrokes waiting for output
+        self.record = record
+        self.recorder = None
+        self.pending = []  # PTY output forwarded but not emulated yet
+        self.emulate_handle = None
 
     def sig_handler(self, signame):
         if signame == "SIGINT" or signame == "SIGTERM":
-            self.shell.write("\x03".encode())
+            self.shell.interrupt("\x03".encode(), discard=True)  # a paste still queued is cancelled too
         elif signame == "SIGTSTP":
-            self.shell.write("\x1a".encode())
+            self.shell.interrupt("\x1a".encode())
         elif signame == "SIGWINCH":
             self.sigqueue.put_nowait(signame)
         else:
@@ -62,8 +84,19 @@ class ClashMaster:
         self.session_id = await(self.session_ready)
 
         cols, rows = self.terminal.start(session_id=self.session_id)
-        self.terminal.input(f"\x1b[38;5;69m\x1b[48;5;0m 🐧collaboration shell - join with:\r\n".encode())
-        self.terminal.input(f"clash {self.session_id} \x1b[m\r\n\r\n".encode())
+        if self.record:
+            self.recorder = ClashRecorder(self.record, self.terminal, log=self.log)
+            self.recorder.keyframe()
+
+        # clashd mirrors the screen from here on and answers joins itself
+        try:
+            await self.ws.send_str(json.dumps({"host": self.host}))
+        except Exception:
+            self.log(traceback.format_exc())
+        await self.send_size()
+
+        await self.handle_terminal(f"\x1b[38;5;69m\x1b[48;5;0m 🐧collaboration shell - join with:\r\n".encode())
+        await self.handle_terminal(f"clash {self.session_id} \x1b[m\r\n\r\n".encode())
 
         self.terminal.set_title(f"[ {self.host} ")
 
@@ -71,7 +104,7 @@ class ClashMaster:
         await self.shell.start(self.handle_terminal, cols, rows)
 
         self.log("stdin: starting")
-        await self.stdin.start(self.handle_stdin)
+        await self.stdin.start(self.handle_stdin, hotkey_handler=self.hotkey_handler)
 
         self.log("idle loop")
         while self.up and self.shell.up and self.stdin.up:
@@ -83,6 +116,8 @@ class ClashMaster:
         await self.stop_master_worker()
         self.log("terminal: stopping...")
         self.terminal.stop()
+        if self.recorder:
+            self.recorder.close()
         self.log("clash: terminated")
         print("[exited]")
 
@@ -95,6 +130,8 @@ class ClashMaster:
 
         if "session" in data:
             session_id = data.get("session")
+            self.binary = data.get("protocol") == PROTOCOL_VERSION
+            self.log(f"session: {session_id} binary: {self.binary}")
             self.session_ready.set_result(session_id)
         elif "join" in data:
             username = data.get("join")
@@ -104,8 +141,22 @@ class ClashMaster:
                 self.log(traceback.format_exc())
             self.members[slave_id] = username
             self.set_title()
-            msg = {"init": {}, "header": {"to": slave_id}}
-            msg["init"]["screen"] = self.terminal.dump()
+            if data.get("mirrored"):  # clashd already sent the screen
+                return
+            if data.get("legacy"):
+                self.legacy.add(slave_id)
+                if self.fast_forward:  # the others get the screen its init has, then output again
+                    self.emulate()
+                    self.seq += 1
+                    msg = {"sync": self.terminal.dump(compact=self.binary), "seq": self.seq}
+                    self.stop_fast_forward(time.monotonic())
+                    try:
+                        await self.ws.send_str(json.dumps(msg))
+                    except Exception:
+                        self.log(traceback.format_exc())
+            self.emulate()
+            msg = {"init": {"seq": self.seq}, "header": {"to": slave_id}}
+            msg["init"]["screen"] = self.terminal.dump(compact=self.binary)
             msg["init"]["host"] = self.host
             msg["init"]["members"] = list(self.members.values())
             if self.ws:
@@ -116,8 +167,17 @@ class ClashMaster:
         elif "input" in data:
             data = base64.b64decode(data.get("input"))
             self.shell.write(data)
+            await self.shell.drain()  # stop reading from clashd while the shell is behind
         elif "signal" in data:
             self.sig_handler(data.get("signal"))
+        elif "resync" in data:  # the slave fell behind and clashd dropped its output
+            self.log(f"resync: {slave_id}")
+            self.emulate()
+            msg = {"sync": self.terminal.dump(compact=self.binary), "seq": self.seq, "header": {"to": slave_id}}
+            try:
+                await self.ws.send_str(json.dumps(msg))
+            except Exception:
+                self.log(traceback.format_exc())
         elif "leave" in data:
             self.log(f"leave: {self.members[slave_id]}")
             try:
@@ -125,8 +185,19 @@ class ClashMaster:
             except Exception:
                 self.log(traceback.format_exc())
             del self.members[slave_id]
+            self.legacy.discard(slave_id)
             self.set_title()
 
+    async def handle_server_frame(self, frame):
+        frame_type, slave_id, _, trace, payload = decode_frame(frame)
+        if frame_type == FRAME_INPUT:
+            if trace:
+                self.traces.append((slave_id, trace, time.monotonic()))
+            self.shell.write(payload)
+            await self.shell.drain()
+        else:
+            self.log(f"frame: unhandled type {frame_type} from {slave_id}")
+
     async def run_master_worker(self, loop):
         self.master_worker = loop.create_future()
 
@@ -140,6 +211,12 @@ class ClashMaster:
                     except Exception:
                         self.log(traceback.format_exc())
 
+                elif msg.type == aiohttp.WSMsgType.BINARY:
+                    try:
+                        await self.handle_server_frame(msg.data)
+                    except Exception:
+                        self.log(traceback.format_exc())
+
                 elif msg.type == aiohttp.WSMsgType.CLOSED:
                     break
                 elif msg.type == aiohttp.WSMsgType.ERROR:
@@ -154,30 +231,137 @@ class ClashMaster:
         asyncio.create_task(worker())
 
     async def handle_stdin(self, data):
+        if self.terminal.scrolling:
+            self.terminal.scroll_key(data)
+            return
         self.shell.write(data)
+        await self.shell.drain()
+
+    async def hotkey_handler(self, key):
+        if key == b'[':  # Ctrl-A [
+            self.terminal.scroll_mode(True)
+        else:  # not ours, the shell gets it
+            self.shell.write(b"\x01" + key)
 
     async def handle_terminal(self, data):
         if not data:
             self.up = False
             return
 
+        # viewers first, the local terminal catches up in the next loop iteration
+        self.log(f"pty: {data}")
+        self.pending.append(data)
+        if not self.emulate_handle:
+            self.emulate_handle = asyncio.get_event_loop().call_soon(self.emulate)
+
+        # fast forward: the output goes out with the next snapshot, the echoes right away
+        if not self.check_fast_forward(len(data)) and self.ws:  # FIXME wait until initialized, mutex?
+            try:
+                if self.binary:
+                    self.seq += 1
+                    await self.ws.send_bytes(encode_frame(FRAME_OUTPUT, data, seq=self.seq))
+                else:
+                    await self.ws.send_str(json.dumps({"output": base64.b64encode(data).decode()}))
+            except Exception:
+                self.log(traceback.format_exc())
+                self.ws = None
+
+        if self.traces and self.ws:
+            await self.send_echoes()
+
+    def emulate(self):
+        """
+        feeds the forwarded output to the terminal, coalesced. Called before
+        anything reads the screen, so snapshots contain everything viewers got.
+        """
+        if self.emulate_handle:
+            self.emulate_handle.cancel()
+            self.emulate_handle = None
+        if not self.pending:
+            return
+        data = b"".join(self.pending)
+        self.pending.clear()
         try:
-            self.log(f"pty: {data}")
             self.terminal.input(data)
+            if self.recorder:
+                self.recorder.output(data)
         except Exception:
             self.log(traceback.format_exc())
 
-        if self.ws:  # FIXME wait until initialized, mutex?
+    async def send_echoes(self):
+        """tells traced keystrokes' senders that output followed"""
+        now = time.monotonic()
+        traces, self.traces = self.traces, []
+        for slave_id, trace, arrival in traces:
+            msg = {"echo": {"trace": trace, "master_ms": (now - arrival) * 1000}, "header": {"to": slave_id}}
             try:
-                await self.ws.send_str(json.dumps({"output": base64.b64encode(data).decode()}))
+                await self.ws.send_str(json.dumps(msg))
             except Exception:
                 self.log(traceback.format_exc())
-                self.ws = None
+
+    def check_fast_forward(self, length):
+        """returns True while output bursts are only emulated, viewers get snapshots meanwhile"""
+        self.output_bytes += length
+        if self.fast_forward:
+            return True
+        if self.legacy or not self.binary:  # viewers that cannot load syncs, or clashd cannot tell
+            return False
+
+        now = time.monotonic()
+        elapsed = now - self.output_window_start
+        if elapsed < FAST_FORWARD_WINDOW:
+            self.output_window_bytes += length
+            return False
+
+        rate = self.output_window_bytes / elapsed
+        self.output_window_start = now
+        self.output_window_bytes = length
+        if rate < FAST_FORWARD_RATE or (self.fast_forward_task and not self.fast_forward_task.done()):
+            return False
+
+        self.log(f"fast forward: {rate / 1024:.0f} KB/s")
+        self.fast_forward = True
+        self.terminal.fps = FAST_FORWARD_FPS
+        self.fast_forward_task = asyncio.create_task(self.fast_forward_worker())
+        return True
+
+    def stop_fast_forward(self, now):
+        self.log("fast forward: done")
+        self.fast_forward = False
+        self.terminal.fps = self.fps
+        self.output_window_start = now
+        self.output_window_bytes = 0
+
+    async def fast_forward_worker(self):
+        last = time.monotonic()
+        output_bytes = self.output_bytes
+        while self.up and self.fast_forward:
+            await asyncio.sleep(FAST_FORWARD_INTERVAL)
+            if not self.fast_forward:  # stopped for a joining viewer
+                break
+            now = time.monotonic()
+            rate = (self.output_bytes - output_bytes) / (now - last)
+            last = now
+            output_bytes = self.output_bytes
+
+            # snapshot and mode switch happen before the send is awaited, so no output
+            # chunk can fall between the snapshot and the first forwarded chunk
+            self.emulate()
+            self.seq += 1
+            msg = {"sync": self.terminal.dump(compact=self.binary), "seq": self.seq}
+            if rate < FAST_FORWARD_RATE and self.terminal.idle():
+                self.stop_fast_forward(now)
+
+            if self.ws:
+                try:
+                    await self.ws.send_str(json.dumps(msg))
+                except Exception:
+                    self.log(traceback.format_exc())
 
     async def init_master_connection(self):
         self.client_session = aiohttp.ClientSession()
         try:
-            self.ws = await self.client_session.ws_connect(self.url)
+            self.ws = await self.client_session.ws_connect(self.url, params={"protocol": PROTOCOL_VERSION})
         except Exception as exc:
             await self.client_session.close()
             print(exc)
@@ -196,11 +380,23 @@ class ClashMaster:
         self.log("master: terminated")
 
     async def resize(self):
+        self.emulate()  # output from before the resize
         cols, rows = self.terminal.resize(full=True, inner=True)
         self.shell.resize(cols - 1, rows - 1)
+        if self.recorder:
+            self.recorder.resize(self.terminal.cols, self.terminal.rows)
+        await self.send_size(cols, rows)
+
+    async def send_size(self, cols=None, rows=None):
+        if cols is None:
+            cols, rows = self.terminal.cols + 1, self.terminal.rows + 1
         if self.ws:
             try:
-                await self.ws.send_str(json.dumps({"resize": [cols, rows]}))
+                if self.binary:
+                    self.seq += 1
+                    await self.ws.send_bytes(encode_frame(FRAME_RESIZE, RESIZE.pack(cols, rows), seq=self.seq))
+                else:
+                    await self.ws.send_str(json.dumps({"resize": [cols, rows]}))
             except Exception:
                 self.log(traceback.format_exc())
 
@@ -0,0 +1,127 @@
+#!/usr/bin/python3
+
+import asyncio
+import time
+
+from bisect import bisect_left
+
+# upper bounds in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+LOOP_LAG_INTERVAL = 0.5  # seconds between event loop lag probes
+
+DIRECTIONS = ("master_in", "master_out", "slave_in", "slave_out")
+
+
+class ClashHistogram:
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name):
+        lines = []
+        total = 0
+        for bound, count in zip(self.buckets, self.counts):
+            total += count
+            lines.append(f'{name}_bucket{{le="{bound}"}} {total}')
+        lines.append(f'{name}_bucket{{le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum {self.sum}")
+        lines.append(f"{name}_count {self.count}")
+        return lines
+
+
+class ClashMetrics:
+    """
+    clashd counters, rendered in the Prometheus text format on /metrics.
+    Only plain ints and floats are updated per message.
+    """
+
+    def __init__(self):
+        self.messages = dict.fromkeys(DIRECTIONS, 0)
+        self.bytes = dict.fromkeys(DIRECTIONS, 0)
+        self.json_errors = 0
+        self.dropped = 0
+        self.resyncs = 0
+        self.send_latency = ClashHistogram()  # slave messages, from queueing until written
+        self.loop_lag = 0.0
+        self.loop_lag_max = 0.0
+        self.monitor = None
+
+    def count(self, direction, length):
+        self.messages[direction] += 1
+        self.bytes[direction] += length
+
+    async def monitor_loop_lag(self):
+        while True:
+            start = time.monotonic()
+            await asyncio.sleep(LOOP_LAG_INTERVAL)
+            self.loop_lag = max(0.0, time.monotonic() - start - LOOP_LAG_INTERVAL)
+            self.loop_lag_max = max(self.loop_lag_max, self.loop_lag)
+
+    async def start(self, app):
+        self.monitor = asyncio.get_event_loop().create_task(self.monitor_loop_lag())
+
+    async def stop(self, app):
+        if self.monitor:
+            self.monitor.cancel()
+
+    def render(self, sessions):
+        viewers = 0
+        queued = 0
+        queued_bytes = 0
+        queued_max = 0
+        for session in sessions.values():
+            viewers += len(session.slaves)
+            for slave in session.slaves.values():
+                queued += len(slave.queue)
+                queued_bytes += slave.queued_bytes
+                queued_max = max(queued_max, len(slave.queue))
+
+        lines = ["# HELP clashd_sessions Active sessions.",
+                 "# TYPE clashd_sessions gauge",
+                 f"clashd_sessions {len(sessions)}",
+                 "# HELP clashd_viewers Connected slaves.",
+                 "# TYPE clashd_viewers gauge",
+                 f"clashd_viewers {viewers}",
+                 "# HELP clashd_messages_total WebSocket messages by direction, as seen from clashd.",
+                 "# TYPE clashd_messages_total counter"]
+        lines += [f'clashd_messages_total{{direction="{d}"}} {self.messages[d]}' for d in DIRECTIONS]
+        lines += ["# HELP clashd_bytes_total WebSocket payload bytes by direction, as seen from clashd.",
+                  "# TYPE clashd_bytes_total counter"]
+        lines += [f'clashd_bytes_total{{direction="{d}"}} {self.bytes[d]}' for d in DIRECTIONS]
+        lines += ["# HELP clashd_queue_messages Messages queued for slaves.",
+                  "# TYPE clashd_queue_messages gauge",
+                  f"clashd_queue_messages {queued}",
+                  "# HELP clashd_queue_bytes Bytes queued for slaves.",
+                  "# TYPE clashd_queue_bytes gauge",
+                  f"clashd_queue_bytes {queued_bytes}",
+                  "# HELP clashd_queue_messages_max Longest slave queue.",
+                  "# TYPE clashd_queue_messages_max gauge",
+                  f"clashd_queue_messages_max {queued_max}",
+                  "# HELP clashd_dropped_total Output messages dropped for slaves that fell behind.",
+                  "# TYPE clashd_dropped_total counter",
+                  f"clashd_dropped_total {self.dropped}",
+                  "# HELP clashd_resyncs_total Snapshots requested for slaves that fell behind.",
+                  "# TYPE clashd_resyncs_total counter",
+                  f"clashd_resyncs_total {self.resyncs}",
+                  "# HELP clashd_json_errors_total Text messages that failed to decode.",
+                  "# TYPE clashd_json_errors_total counter",
+                  f"clashd_json_errors_total {self.json_errors}",
+                  "# HELP clashd_send_latency_seconds Time slave messages spent queued until written.",
+                  "# TYPE clashd_send_latency_seconds histogram"]
+        lines += self.send_latency.render("clashd_send_latency_seconds")
+        lines += ["# HELP clashd_loop_lag_seconds Event loop lag at the last probe.",
+                  "# TYPE clashd_loop_lag_seconds gauge",
+                  f"clashd_loop_lag_seconds {self.loop_lag}",
+                  "# HELP clashd_loop_lag_max_seconds Largest event loop lag seen.",
+                  "# TYPE clashd_loop_lag_max_seconds gauge",
+                  f"clashd_loop_lag_max_seconds {self.loop_lag_max}"]
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,271 @@
+#!/usr/bin/python3
+
+import codecs
+import re
+
+# parser states, see https://vt100.net/emu/dec_ansi_parser
+GROUND = 0
+ESCAPE = 1
+ESCAPE_INTERMEDIATE = 2
+CSI_ENTRY = 3
+CSI_PARAM = 4
+CSI_INTERMEDIATE = 5
+CSI_IGNORE = 6
+OSC_STRING = 7
+STRING_IGNORE = 8
+
+# byte classes
+C0 = 0
+INTERMEDIATE = 1    # 0x20 - 0x2f
+DIGIT = 2           # 0x30 - 0x39
+SEPARATOR = 3       # ; and :
+PRIVATE = 4         # < = > ?
+FINAL = 5           # 0x40 - 0x7e
+DEL = 6
+HIGH = 7            # 0x80 - 0xff
+ESC = 8
+CANCEL = 9          # CAN, SUB
+
+CLASSES = bytearray(256)
+for b in range(256):
+    if b == 0x1b:
+        CLASSES[b] = ESC
+    elif b in (0x18, 0x1a):
+        CLASSES[b] = CANCEL
+    elif b < 0x20:
+        CLASSES[b] = C0
+    elif b < 0x30:
+        CLASSES[b] = INTERMEDIATE
+    elif b < 0x3a:
+        CLASSES[b] = DIGIT
+    elif b < 0x3c:
+        CLASSES[b] = SEPARATOR
+    elif b < 0x40:
+        CLASSES[b] = PRIVATE
+    elif b < 0x7f:
+        CLASSES[b] = FINAL
+    elif b == 0x7f:
+        CLASSES[b] = DEL
+    else:
+        CLASSES[b] = HIGH
+
+MAX_PARAM = 65535
+MAX_OSC = 4096
+
+# complete, well formed CSI sequences are matched in one go, the state machine handles the rest
+CSI_SEQUENCE = re.compile(rb"\[([<=>?]?)([0-9;:]{0,32})([ -/]{0,2})([@-~])")
+
+
+class ClashParser:
+    """
+    Single pass VT500 style escape sequence parser.
+
+    Plain text is located with bytes.find and handed to `text` in one piece. Complete
+    CSI sequences are matched in a single step, everything else (split or malformed
+    sequences, ESC, OSC and string states) is walked byte by byte. Sequences are
+    dispatched through the handler tables:
+
+        csi: {private + intermediates + final: handler(params)}  params are ints, omitted ones 0
+        esc: {intermediates + final: handler([final])}, falls back to {intermediates: ...}
+        osc: {command: handler([text])}
+
+    The parser state survives between calls to feed(), so sequences may be split
+    across PTY reads.
+    """
+
+    def __init__(self, text, csi, esc, osc, unhandled, log=None):
+        self.text = text
+        self.csi = csi
+        self.esc = esc
+        self.osc = osc
+        self.unhandled = unhandled
+        self.log = log
+        self.decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self.reset()
+
+    def reset(self):
+        self.state = GROUND
+        self.decoder.reset()
+        self.clear()
+
+    def clear(self):
+        self.params = []
+        self.param = None
+        self.private = ""
+        self.intermediates = ""
+        self.string = bytearray()
+
+    def feed(self, data):
+        classes = CLASSES
+        state = self.state
+        i = 0
+        n = len(data)
+        csi_sequence = CSI_SEQUENCE.match
+        csi = self.csi
+        while i < n:
+            if state == GROUND:
+                j = data.find(b"\x1b", i)
+                if j < 0:
+                    j = n
+                if j > i:
+                    self.text(self.decoder.decode(data[i:j]))
+                if j == n:
+                    break
+                m = csi_sequence(data, j + 1)
+                if m:
+                    private, params, intermediates, final = m.groups()
+                    if params:
+                        params = [int(p) if p else 0 for p in params.replace(b":", b";").split(b";")]
+                        if max(params) > MAX_PARAM:
+                            params = [min(p, MAX_PARAM) for p in params]
+                    else:
+                        params = []
+                    key = (private + intermediates + final).decode()
+                    handler = csi.get(key)
+                    if handler is None:
+                        self.csi_unhandled(key, params)
+                    else:
+                        handler(params)
+                    i = m.end()
+                    continue
+                i = j + 1
+                self.clear()
+                state = ESCAPE
+                continue
+
+            b = data[i]
+            i += 1
+            cls = classes[b]
+
+            if cls == ESC:
+                if state == OSC_STRING or state == STRING_IGNORE:
+                    # ESC \ (ST) terminates strings, anything else aborts them
+                    if state == OSC_STRING:
+                        self.osc_dispatch()
+                self.clear()
+                state = ESCAPE
+                continue
+
+            if cls == CANCEL:
+                state = GROUND
+                continue
+
+            if state == OSC_STRING:
+                if b == 0x07:  # BEL
+                    self.osc_dispatch()
+                    state = GROUND
+                elif cls != C0 and len(self.string) < MAX_OSC:
+                    self.string.append(b)
+                continue
+
+            if state == STRING_IGNORE:
+                if b == 0x07:
+                    state = GROUND
+                continue
+
+            if cls == C0:  # control characters are executed within sequences
+                self.text(chr(b))
+                continue
+
+            if cls == DEL:
+                continue
+
+            if state == ESCAPE:
+                if cls == INTERMEDIATE:
+                    self.intermediates += chr(b)
+                    state = ESCAPE_INTERMEDIATE
+                elif b == 0x5b:  # [
+                    state = CSI_ENTRY
+                elif b == 0x5d:  # ]
+                    state = OSC_STRING
+                elif b in (0x50, 0x58, 0x5e, 0x5f):  # DCS, SOS, PM, APC
+                    state = STRING_IGNORE
+                elif b == 0x5c:  # ST without string
+                    state = GROUND
+                elif cls != HIGH:
+                    self.esc_dispatch(chr(b))
+                    state = GROUND
+                else:
+                    state = GROUND
+
+            elif state == ESCAPE_INTERMEDIATE:
+                if cls == INTERMEDIATE:
+                    self.intermediates += chr(b)
+                else:
+                    if cls != HIGH:
+                        self.esc_dispatch(chr(b))
+                    state = GROUND
+
+            elif state == CSI_ENTRY or state == CSI_PARAM:
+                if cls == DIGIT:
+                    param = (self.param or 0) * 10 + b - 0x30
+                    self.param = param if param < MAX_PARAM else MAX_PARAM
+                    state = CSI_PARAM
+                elif cls == SEPARATOR:
+                    self.params.append(self.param or 0)
+                    self.param = None
+                    state = CSI_PARAM
+                elif cls == FINAL:
+                    self.csi_dispatch(chr(b))
+                    state = GROUND
+                elif cls == PRIVATE:
+                    if state == CSI_ENTRY:
+                        self.private = chr(b)
+                        state = CSI_PARAM
+                    else:
+                        state = CSI_IGNORE
+                elif cls == INTERMEDIATE:
+                    self.intermediates += chr(b)
+                    state = CSI_INTERMEDIATE
+                else:
+                    state = CSI_IGNORE
+
+            elif state == CSI_INTERMEDIATE:
+                if cls == INTERMEDIATE:
+                    self.intermediates += chr(b)
+                elif cls == FINAL:
+                    self.csi_dispatch(chr(b))
+                    state = GROUND
+                else:
+                    state = CSI_IGNORE
+
+            elif state == CSI_IGNORE:
+                if cls == FINAL:
+                    state = GROUND
+
+        self.state = state
+
+    def csi_dispatch(self, final):
+        if self.param is not None or self.params:
+            self.params.append(self.param or 0)
+        key = self.private + self.intermediates + final
+        handler = self.csi.get(key)
+        if handler is None:
+            self.csi_unhandled(key, self.params)
+            return
+        handler(self.params)
+
+    def csi_unhandled(self, key, params):
+        self.unhandled([f"[{key[:-1]}{';'.join(map(str, params))}{key[-1]}"])
+
+    def esc_dispatch(self, final):
+        handler = self.esc.get(self.intermediates + final)
+        if handler is None:
+            handler = self.esc.get(self.intermediates)
+        if handler is None:
+            self.unhandled([f"{self.intermediates}{final}"])
+            return
+        handler([final])
+
+    def osc_dispatch(self):
+        string = self.string.decode(errors="replace")
+        command, _, text = string.partition(";")
+        try:
+            command = int(command)
+        except ValueError:
+            pass
+        handler = self.osc.get(command)
+        if handler is None:
+            self.unhandled([f"]{string}"])
+            return
+        handler([text])
@@ -0,0 +1,63 @@
+#!/usr/bin/python3
+
+import base64
+import struct
+
+# Binary frames carry terminal I/O, control messages stay JSON text frames.
+# Peers ask for binary frames with ?protocol=N when connecting, clashd confirms
+# with {"protocol": N} (masters get it in the session message), peers that never
+# asked keep getting JSON only.
+#
+# Slaves on slow links may ask for state sync with ?state=1 as well, clashd then
+# confirms with {"protocol": N, "state": true} and sends them screen diffs
+# (FRAME_STATE) against the last state sent instead of the output, one at a
+# time: the next one waits for the slave's FRAME_ACK.
+
+PROTOCOL_VERSION = 1
+
+FRAME_OUTPUT = 1  # master -> slaves: pty output
+FRAME_INPUT = 2   # slave -> master: keystrokes
+FRAME_RESIZE = 3  # master -> slaves: payload is RESIZE (cols, rows)
+FRAME_STATE = 4   # clashd -> state sync slaves: payload is STATE (cursor, modes) and a screen diff
+FRAME_ACK = 5     # state sync slave -> clashd: the state with this sequence number is shown
+
+HEADER = struct.Struct("!BBHHI")  # version, type, from, to, sequence
+RESIZE = struct.Struct("!HH")
+STATE = struct.Struct("!HHB")  # cursor col, row, modes
+STATE_CURSOR_VISIBLE = 0x01
+STATE_BRACKETED_PASTE = 0x02
+NOBODY = 0xffff  # from the master / to everybody
+
+
+def encode_frame(frame_type, payload, sender=NOBODY, to=NOBODY, seq=0):
+    return HEADER.pack(PROTOCOL_VERSION, frame_type, sender, to, seq & 0xffffffff) + payload
+
+
+def decode_frame(data):
+    """returns (type, from, to, seq, payload)"""
+    if len(data) < HEADER.size:
+        raise ValueError(f"short frame: {len(data)} bytes")
+    version, frame_type, sender, to, seq = HEADER.unpack_from(data)
+    if version != PROTOCOL_VERSION:
+        raise ValueError(f"unsupported frame version {version}")
+    return frame_type, sender, to, seq, data[HEADER.size:]
+
+
+def set_sender(data, sender):
+    """returns the frame with the from field replaced"""
+    return data[:2] + struct.pack("!H", sender) + data[4:]
+
+
+def frame_to_json(frame_type, sender, payload):
+    """JSON message equivalent to a binary frame, for peers without binary framing"""
+    if frame_type == FRAME_OUTPUT:
+        msg = {"output": base64.b64encode(payload).decode()}
+    elif frame_type == FRAME_INPUT:
+        msg = {"input": base64.b64encode(payload).decode()}
+    elif frame_type == FRAME_RESIZE:
+        msg = {"resize": list(RESIZE.unpack(payload))}
+    else:
+        raise ValueError(f"unknown frame type {frame_type}")
+    if sender != NOBODY:
+        msg["header"] = {"from": sender}
+    return msg
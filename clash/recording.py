@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+import asyncio
+import json
+import os
+import struct
+import time
+
+from bisect import bisect_right
+
+from .terminal import ClashTerminal
+from .stdin import ClashStdin
+
+# A recording is a magic header followed by records, each a RECORD header
+# (type, seconds since the start, payload length) and the payload. Keyframes
+# are dump(compact=True) snapshots taken every KEYFRAME_INTERVAL seconds of
+# output; their (time, file offset) pairs are appended to <recording>.idx so
+# playback can seek without reading everything before.
+
+MAGIC = b"CLASHREC\x01"
+RECORD = struct.Struct("!BdI")
+INDEX = struct.Struct("!dQ")
+
+RECORD_OUTPUT = 1    # PTY output
+RECORD_KEYFRAME = 2  # screen snapshot, JSON
+RECORD_RESIZE = 3    # RESIZE_PAYLOAD (cols, rows)
+
+RESIZE_PAYLOAD = struct.Struct("!HH")
+
+KEYFRAME_INTERVAL = 10     # seconds
+WRITE_BUFFER = 256 * 1024  # bytes buffered before they are written
+FLUSH_INTERVAL = 1         # seconds between flushes of what is buffered
+
+SEEK_STEP = 10  # seconds the arrow keys jump during playback
+
+
+class ClashRecorder:
+    """
+    Append-only session recording. Records are collected in memory and written
+    out by the file object's buffer, flushed once a second, so recording output
+    is a struct pack and a buffer append.
+    """
+
+    def __init__(self, path, terminal, log=None, keyframe_interval=KEYFRAME_INTERVAL):
+        self.path = path
+        self.terminal = terminal
+        self.log = log
+        self.keyframe_interval = keyframe_interval
+        self.file = open(path, "wb", buffering=WRITE_BUFFER)
+        self.index = open(path + ".idx", "wb", buffering=WRITE_BUFFER)
+        self.file.write(MAGIC)
+        self.offset = len(MAGIC)
+        self.start = time.monotonic()
+        self.last_keyframe = None
+        self.flush_handle = None
+
+    def write(self, record_type, payload, now=None):
+        if now is None:
+            now = time.monotonic() - self.start
+        self.file.write(RECORD.pack(record_type, now, len(payload)))
+        self.file.write(payload)
+        offset = self.offset
+        self.offset += RECORD.size + len(payload)
+        if not self.flush_handle:
+            self.flush_handle = asyncio.get_event_loop().call_later(FLUSH_INTERVAL, self.flush)
+        return offset
+
+    def keyframe(self):
+        now = time.monotonic() - self.start
+        snapshot = json.dumps(self.terminal.dump(compact=True)).encode()
+        offset = self.write(RECORD_KEYFRAME, snapshot, now)
+        self.index.write(INDEX.pack(now, offset))
+        self.last_keyframe = now
+
+    def output(self, data):
+        """call after the terminal got data, so keyframes include it"""
+        self.write(RECORD_OUTPUT, data)
+        if self.last_keyframe is None or time.monotonic() - self.start - self.last_keyframe >= self.keyframe_interval:
+            if self.terminal.idle():
+                self.keyframe()
+
+    def resize(self, cols, rows):
+        self.write(RECORD_RESIZE, RESIZE_PAYLOAD.pack(cols, rows))
+        self.keyframe()
+
+    def flush(self):
+        self.flush_handle = None
+        try:
+            self.file.flush()
+            self.index.flush()
+        except Exception as exc:
+            if self.log:
+                self.log(f"record: {exc}")
+
+    def close(self):
+        if self.flush_handle:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.file.close()
+        self.index.close()
+
+
+def read_record(f):
+    header = f.read(RECORD.size)
+    if len(header) < RECORD.size:
+        return None
+    record_type, timestamp, length = RECORD.unpack(header)
+    payload = f.read(length)
+    if len(payload) < length:  # cut off while recording
+        return None
+    return record_type, timestamp, payload
+
+
+class ClashPlayer:
+    """
+    Plays a recording in real time. Seeking restores the last keyframe before
+    the target and replays only the output after it.
+
+    Keys: space pauses, left/right jump SEEK_STEP seconds, q quits.
+    """
+
+    def __init__(self, path, log=None, fps=60):
+        self.path = path
+        self.log = log
+        self.file = open(path, "rb")
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"{path} is not a clash recording")
+        self.keyframes = self.load_index()
+        self.duration = self.read_duration()
+        self.terminal = ClashTerminal(log=log, fps=fps)
+        self.stdin = ClashStdin(log=log)
+        self.position = 0    # seconds into the recording
+        self.clock = None    # monotonic time corresponding to position 0 while playing
+        self.paused = False
+        self.up = True
+        self.wakeup = asyncio.Event()
+
+    def load_index(self):
+        keyframes = []
+        path = self.path + ".idx"
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                data = f.read()
+            for i in range(0, len(data) - INDEX.size + 1, INDEX.size):
+                keyframes.append(INDEX.unpack_from(data, i))
+        if not keyframes:  # index lost, scan for the keyframes
+            self.file.seek(len(MAGIC))
+            while True:
+                offset = self.file.tell()
+                record = read_record(self.file)
+                if record is None:
+                    break
+                if record[0] == RECORD_KEYFRAME:
+                    keyframes.append((record[1], offset))
+        if not keyframes:
+            raise ValueError(f"{self.path} has no keyframes")
+        return keyframes
+
+    def read_duration(self):
+        # from the last keyframe on, records are only skimmed
+        self.file.seek(self.keyframes[-1][1])
+        duration = self.keyframes[-1][0]
+        while True:
+            header = self.file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            _, duration, length = RECORD.unpack(header)
+            self.file.seek(length, os.SEEK_CUR)
+        return duration
+
+    def restore(self, payload):
+        screen = json.loads(payload)
+        if screen["cols"] != self.terminal.cols or screen["rows"] != self.terminal.rows:
+            self.terminal.resize(full=False, inner=True, cols=screen["cols"], rows=screen["rows"])
+        self.terminal.restore(screen)
+
+    def apply(self, record):
+        record_type, _, payload = record
+        if record_type == RECORD_OUTPUT:
+            self.terminal.input(payload)
+        elif record_type == RECORD_KEYFRAME:
+            self.restore(payload)
+        elif record_type == RECORD_RESIZE:
+            cols, rows = RESIZE_PAYLOAD.unpack(payload)
+            self.terminal.resize(full=False, inner=True, cols=cols, rows=rows)
+
+    def seek(self, position):
+        """restores the state at position, O(keyframe interval)"""
+        position = max(0, min(position, self.duration))
+        index = max(0, bisect_right([k[0] for k in self.keyframes], position) - 1)
+        self.file.seek(self.keyframes[index][1])
+        while True:
+            offset = self.file.tell()
+            record = read_record(self.file)
+            if record is None:
+                break
+            if record[1] > position:
+                self.file.seek(offset)  # played when its time comes
+                break
+            self.apply(record)
+        self.position = position
+        self.clock = time.monotonic() - position
+        self.terminal.refresh()
+        self.update_status()
+        self.wakeup.set()
+
+    def update_status(self):
+        state = "paused" if self.paused else "play"
+        self.terminal.set_status(f" {state} {format_time(self.position)}/{format_time(self.duration)} ")
+
+    async def handle_stdin(self, data):
+        if data == b"q":
+            self.up = False
+        elif data == b" ":
+            self.paused = not self.paused
+            if not self.paused:
+                self.clock = time.monotonic() - self.position
+            self.update_status()
+            self.terminal.refresh()
+        elif data == b"\x1b[C":
+            self.seek(self.position + SEEK_STEP)
+        elif data == b"\x1b[D":
+            self.seek(self.position - SEEK_STEP)
+        self.wakeup.set()
+
+    async def play_worker(self):
+        while self.up:
+            if self.paused:
+                self.wakeup.clear()
+                await self.wakeup.wait()
+                continue
+            offset = self.file.tell()
+            record = read_record(self.file)
+            if record is None:  # the end, wait for a seek or quit
+                self.paused = True
+                self.position = self.duration
+                self.update_status()
+                continue
+            delay = self.clock + record[1] - time.monotonic()
+            if delay > 0:
+                self.file.seek(offset)
+                self.wakeup.clear()
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            self.apply(record)
+            previous = int(self.position)
+            self.position = record[1]
+            if int(self.position) != previous:
+                self.update_status()
+
+    async def run(self, position=0):
+        self.file.seek(self.keyframes[0][1])
+        screen = json.loads(read_record(self.file)[2])
+        self.terminal.start(screen["cols"], screen["rows"], session_id=os.path.basename(self.path))
+        self.terminal.set_title(" ▶ clash play ")
+        self.seek(position)
+
+        await self.stdin.start(self.handle_stdin)
+        await self.play_worker()
+        await self.stdin.stop()
+        self.terminal.stop()
+        self.file.close()
+
+
+def format_time(seconds):
+    return f"{int(seconds) // 60:02d}:{int(seconds) % 60:02d}"
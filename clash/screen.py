@@ -0,0 +1,355 @@
+#!/usr/bin/python3
+
+import struct
+import sys
+import zlib
+
+from array import array
+from collections import deque
+from itertools import groupby
+
+# cell attributes are packed into one int: fg + 1, bg + 1 (0 = default color) and flags
+FG_MASK = 0x1ff
+BG_SHIFT = 9
+BG_MASK = 0x1ff << BG_SHIFT
+A_BOLD = 1 << 18
+A_DIM = 1 << 19
+A_ITALIC = 1 << 20
+A_UNDERLINE = 1 << 21
+A_BLINK = 1 << 22
+A_REVERSE = 1 << 23
+A_STANDOUT = 1 << 24
+FLAGS_MASK = ~(FG_MASK | BG_MASK)
+
+SPACE = ord(" ")
+
+# packed snapshots, see ClashScreen.snapshot()
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("!BBHHH")  # version, flags, cols, rows, attribute table size
+SNAPSHOT_DEFLATE = 1
+SNAPSHOT_DEFLATE_MIN = 256  # bytes, smaller snapshots are sent as they are
+DIFF_HEADER = struct.Struct("!BBHHHH")  # version, flags, cols, rows, attribute table size, changed rows
+
+
+def pack_attr(fg, bg, flags):
+    return flags | (fg + 1) | ((bg + 1) << BG_SHIFT)
+
+
+def unpack_attr(attr):
+    return (attr & FG_MASK) - 1, ((attr & BG_MASK) >> BG_SHIFT) - 1, attr & FLAGS_MASK
+
+
+def encode(text):
+    chars = array("I")
+    chars.frombytes(text.encode("utf-32-le", errors="replace"))
+    return chars
+
+
+def network_order(values):
+    if sys.byteorder == "little":
+        values.byteswap()
+    return values
+
+
+class ClashScreen:
+    """
+    Headless screen model: one array of codepoints and one array of packed
+    attributes per row. Damage since the last render is kept in `dirty` as
+    {row: [start, end]} column spans.
+    """
+
+    def __init__(self, cols=0, rows=0):
+        self.cols = cols
+        self.rows = rows
+        self.chars = [self.blank_chars() for _ in range(rows)]
+        self.attrs = [self.blank_attrs() for _ in range(rows)]
+        self.dirty = {}
+        self.touch_all()
+
+    def touch(self, row, start, end):
+        span = self.dirty.get(row)
+        if span is None:
+            self.dirty[row] = [start, end]
+        else:
+            if start < span[0]:
+                span[0] = start
+            if end > span[1]:
+                span[1] = end
+
+    def touch_rows(self, top, bottom):
+        for row in range(top, bottom):
+            self.dirty[row] = [0, self.cols]
+
+    def touch_all(self):
+        self.touch_rows(0, self.rows)
+
+    def blank_chars(self, length=None):
+        return array("I", [SPACE]) * (self.cols if length is None else length)
+
+    def blank_attrs(self, attr=0, length=None):
+        return array("I", [attr]) * (self.cols if length is None else length)
+
+    def write(self, row, col, text, attr):
+        if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+            return
+        chars = encode(text[:self.cols - col])
+        length = len(chars)
+        self.chars[row][col:col + length] = chars
+        self.attrs[row][col:col + length] = self.blank_attrs(attr, length)
+        self.touch(row, col, col + length)
+
+    def fill(self, row, col, length, attr):
+        if row < 0 or row >= self.rows or col < 0:
+            return
+        length = min(length, self.cols - col)
+        if length <= 0:
+            return
+        self.chars[row][col:col + length] = self.blank_chars(length)
+        self.attrs[row][col:col + length] = self.blank_attrs(attr, length)
+        self.touch(row, col, col + length)
+
+    def clear(self, attr=0):
+        for row in range(self.rows):
+            self.fill(row, 0, self.cols, attr)
+
+    def scroll(self, top, bottom, count, attr=0):
+        """scroll rows top..bottom-1 up by count lines, down if count is negative"""
+        top = max(top, 0)
+        bottom = min(bottom, self.rows)
+        if bottom - top < 1 or not count:
+            return
+        count = max(min(count, bottom - top), top - bottom)
+        for _ in range(abs(count)):
+            if count > 0:
+                del self.chars[top]
+                del self.attrs[top]
+                self.chars.insert(bottom - 1, self.blank_chars())
+                self.attrs.insert(bottom - 1, self.blank_attrs(attr))
+            else:
+                del self.chars[bottom - 1]
+                del self.attrs[bottom - 1]
+                self.chars.insert(top, self.blank_chars())
+                self.attrs.insert(top, self.blank_attrs(attr))
+        self.touch_rows(top, bottom)
+
+    def insert_chars(self, row, col, num, attr):
+        if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+            return
+        num = min(num, self.cols - col)
+        chars = self.chars[row]
+        attrs = self.attrs[row]
+        chars[col:self.cols] = self.blank_chars(num) + chars[col:self.cols - num]
+        attrs[col:self.cols] = self.blank_attrs(attr, num) + attrs[col:self.cols - num]
+        self.touch(row, col, self.cols)
+
+    def delete_chars(self, row, col, num, attr):
+        if row < 0 or row >= self.rows or col < 0 or col >= self.cols:
+            return
+        num = min(num, self.cols - col)
+        chars = self.chars[row]
+        attrs = self.attrs[row]
+        chars[col:self.cols] = chars[col + num:self.cols] + self.blank_chars(num)
+        attrs[col:self.cols] = attrs[col + num:self.cols] + self.blank_attrs(attr, num)
+        self.touch(row, col, self.cols)
+
+    def resize(self, cols, rows):
+        for row in range(min(rows, self.rows)):
+            length = len(self.chars[row])
+            if cols > length:
+                self.chars[row].extend(self.blank_chars(cols - length))
+                self.attrs[row].extend(self.blank_attrs(0, cols - length))
+            else:
+                del self.chars[row][cols:]
+                del self.attrs[row][cols:]
+        del self.chars[rows:]
+        del self.attrs[rows:]
+        self.cols = cols
+        for _ in range(self.rows, rows):
+            self.chars.append(self.blank_chars())
+            self.attrs.append(self.blank_attrs())
+        self.rows = rows
+        self.dirty = {}
+        self.touch_all()
+
+    def save(self):
+        return [array("I", row) for row in self.chars], [array("I", row) for row in self.attrs]
+
+    def load(self, saved):
+        chars, attrs = saved
+        cols, rows = self.cols, self.rows
+        self.cols = len(chars[0]) if chars else cols
+        self.rows = len(chars)
+        self.chars = [array("I", row) for row in chars]
+        self.attrs = [array("I", row) for row in attrs]
+        self.resize(cols, rows)
+
+    def load_lines(self, lines, attrs):
+        self.load(([encode(line) for line in lines], [array("I", row) for row in attrs]))
+
+    def pack_rows(self, rows):
+        """
+        attribute table size and the rows packed as:
+
+            attribute table (uint32 each),
+            number of attribute runs per row (uint16 each),
+            runs as (length, attribute table index) uint16 pairs,
+            the rows' text in UTF-8 without trailing blanks, separated by newlines
+
+        deflated when that pays off, and the flags telling so
+        """
+        table = {}
+        counts = array("H")
+        runs = array("H")
+        for row in rows:
+            row_runs = 0
+            for attr, cells in groupby(self.attrs[row]):
+                index = table.setdefault(attr, len(table))
+                runs.append(sum(1 for _ in cells))
+                runs.append(index)
+                row_runs += 1
+            counts.append(row_runs)
+        text = "\n".join(self.line(row).rstrip(" ") for row in rows).encode("utf-8", errors="replace")
+        data = b"".join((network_order(array("I", table)).tobytes(),
+                         network_order(counts).tobytes(),
+                         network_order(runs).tobytes(),
+                         text))
+        flags = 0
+        if len(data) >= SNAPSHOT_DEFLATE_MIN:
+            flags |= SNAPSHOT_DEFLATE
+            data = zlib.compress(data)
+        return flags, len(table), data
+
+    def unpack_rows(self, data, flags, table_size, count, cols):
+        """(chars, attrs) of `count` rows from pack_rows(), cut or padded to cols"""
+        if flags & SNAPSHOT_DEFLATE:
+            data = zlib.decompress(data)
+
+        offset = 0
+        table = array("I")
+        table.frombytes(data[offset:offset + 4 * table_size])
+        network_order(table)
+        offset += 4 * table_size
+        counts = array("H")
+        counts.frombytes(data[offset:offset + 2 * count])
+        network_order(counts)
+        offset += 2 * count
+        runs = array("H")
+        runs.frombytes(data[offset:offset + 4 * sum(counts)])
+        network_order(runs)
+        offset += 4 * sum(counts)
+        lines = data[offset:].decode("utf-8", errors="replace").split("\n")
+
+        chars = []
+        attrs = []
+        run = 0
+        blank = array("I", [SPACE])
+        for row in range(count):
+            line = encode(lines[row][:cols]) if row < len(lines) else array("I")
+            chars.append(line + blank * (cols - len(line)))
+            row_attrs = array("I")
+            for _ in range(counts[row]):
+                row_attrs.extend(array("I", [table[runs[run + 1]]]) * runs[run])
+                run += 2
+            del row_attrs[cols:]
+            row_attrs.extend(array("I", [0]) * (cols - len(row_attrs)))
+            attrs.append(row_attrs)
+        return chars, attrs
+
+    def snapshot(self):
+        """packed screen contents: header and all rows as by pack_rows()"""
+        flags, table_size, data = self.pack_rows(range(self.rows))
+        return SNAPSHOT_HEADER.pack(SNAPSHOT_VERSION, flags, self.cols, self.rows, table_size) + data
+
+    def load_snapshot(self, snapshot):
+        """restores a snapshot() row by row, resized to the current size"""
+        version, flags, cols, rows, table_size = SNAPSHOT_HEADER.unpack_from(snapshot)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported snapshot version {version}")
+        self.load(self.unpack_rows(snapshot[SNAPSHOT_HEADER.size:], flags, table_size, rows, cols))
+
+    def changed(self, base):
+        """rows that differ from `base`, a save() of an earlier state, all of them if the size changed"""
+        if base is None or len(base[0]) != self.rows or (base[0] and len(base[0][0]) != self.cols):
+            return list(range(self.rows))
+        chars, attrs = base
+        return [row for row in range(self.rows) if self.chars[row] != chars[row] or self.attrs[row] != attrs[row]]
+
+    def diff(self, rows):
+        """header, row numbers (uint16 each) and the rows as by pack_rows()"""
+        flags, table_size, data = self.pack_rows(rows)
+        header = DIFF_HEADER.pack(SNAPSHOT_VERSION, flags, self.cols, self.rows, table_size, len(rows))
+        return header + network_order(array("H", rows)).tobytes() + data
+
+    def load_diff(self, diff):
+        """applies a diff(), the screen must have the size given in it"""
+        version, flags, cols, rows, table_size, count = DIFF_HEADER.unpack_from(diff)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError(f"unsupported diff version {version}")
+        if (cols, rows) != (self.cols, self.rows):
+            raise ValueError(f"diff for {cols}x{rows} on a {self.cols}x{self.rows} screen")
+        offset = DIFF_HEADER.size
+        numbers = array("H")
+        numbers.frombytes(diff[offset:offset + 2 * count])
+        network_order(numbers)
+        offset += 2 * count
+        chars, attrs = self.unpack_rows(diff[offset:], flags, table_size, count, cols)
+        for row, row_chars, row_attrs in zip(numbers, chars, attrs):
+            self.chars[row] = row_chars
+            self.attrs[row] = row_attrs
+            self.dirty[row] = [0, cols]
+
+    def line(self, row, start=0, end=None):
+        return self.chars[row][start:end].tobytes().decode("utf-32-le", errors="replace")
+
+    def runs(self, row, start=0, end=None):
+        """(start, end, attr) spans of equal attributes"""
+        runs = []
+        for attr, cells in groupby(self.attrs[row][start:end]):
+            stop = start + sum(1 for _ in cells)
+            runs.append((start, stop, attr))
+            start = stop
+        return runs
+
+
+class ClashScrollback:
+    """
+    Lines scrolled off the top of the screen, oldest first, at most `capacity` of
+    them. Appending evicts the oldest line once full, both O(1).
+
+    A line is kept as its codepoints without trailing blanks plus its attributes
+    as (length, attr) runs, both arrays, so memory stays around
+    capacity * (4 bytes per printed character + 8 per attribute run + ~150 overhead).
+    """
+
+    def __init__(self, capacity=0):
+        self.capacity = capacity
+        self.lines = deque(maxlen=capacity)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def clear(self):
+        self.lines.clear()
+
+    def push(self, chars, attrs):
+        length = len(chars.tobytes().decode("utf-32-le", errors="replace").rstrip(" "))
+        if not attrs or attrs.count(attrs[0]) == len(attrs):
+            runs = array("I", [len(attrs), attrs[0] if attrs else 0])
+        else:
+            runs = array("I")
+            for attr, cells in groupby(attrs):
+                runs.append(sum(1 for _ in cells))
+                runs.append(attr)
+        self.lines.append((chars[:length], runs))
+
+    def line(self, index, cols):
+        """(chars, attrs) of a line, cut or padded to cols"""
+        chars, runs = self.lines[index]
+        chars = chars[:cols]
+        chars.extend(array("I", [SPACE]) * (cols - len(chars)))
+        attrs = array("I")
+        for i in range(0, len(runs), 2):
+            attrs.extend(array("I", [runs[i + 1]]) * runs[i])
+        del attrs[cols:]
+        attrs.extend(array("I", [0]) * (cols - len(attrs)))
+        return chars, attrs
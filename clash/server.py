@@ -0,0 +1,992 @@
+#!/usr/bin/python3
+
+import asyncio
+import base64
+import functools
+import hashlib
+import itertools
+import json
+import os
+import secrets
+import signal
+import socket
+import tempfile
+import time
+import traceback
+import zlib
+
+from collections import deque
+
+import aiohttp
+from aiohttp import web, WSMsgType
+
+from .protocol import (PROTOCOL_VERSION, NOBODY, FRAME_OUTPUT, FRAME_INPUT, FRAME_RESIZE, RESIZE, decode_frame, set_sender,
+                       frame_to_json)
+from .protocol import FRAME_STATE, FRAME_ACK, encode_frame
+from .terminal import ClashTerminal
+from .metrics import ClashMetrics
+from .slave import RECONNECT_ATTEMPTS, RECONNECT_DELAY
+
+MAX_QUEUE_MESSAGES = 1024            # queued messages per slave before it is resynced
+MAX_QUEUE_BYTES = 4 * 1024 * 1024    # queued bytes per slave before it is resynced
+REPLAY_BYTES = 1024 * 1024           # output kept per session for slaves resuming after a reconnect
+MAX_TRACES = 1024                    # traced keystrokes per slave waiting for their echo
+STATE_INTERVAL = 1 / 30              # seconds between screen diffs to a state sync slave at least
+FORWARDED = "X-Clash-Forwarded"      # set on slaves relayed from a peer, they are not relayed again
+RELAY_LINGER = RECONNECT_ATTEMPTS * RECONNECT_DELAY  # seconds a relayed session outlives its last slave
+HEARTBEAT = 20                       # seconds between pings to slaves, a missed pong closes half-open ones
+
+
+def session_node(session_id, peers):
+    """the peer a session lives on, rendezvous hashing so adding a peer only moves sessions to it"""
+    return max(peers, key=lambda peer: hashlib.sha1(f"{peer} {session_id}".encode()).digest())
+
+
+def session_owner(session_id, workers):
+    """index of the worker process a session lives in"""
+    return zlib.crc32(session_id.encode()) % workers
+
+
+def worker_socket(port, worker):
+    """Unix socket the worker process accepts forwarded slaves on"""
+    return os.path.join(tempfile.gettempdir(), f"clashd-{port}-{worker}.sock")
+
+
+class ClashSlaveConnection():
+    """
+    A slave websocket with its own writer task, so broadcasts only enqueue the
+    (already encoded) message and a slow viewer does not hold up the others.
+
+    The queue is bounded: a slave falling too far behind loses its queued output
+    (deltas), `resync` is called to get it a fresh screen snapshot, and further
+    output is dropped until send_snapshot() delivers one. A snapshot replaces the
+    output and snapshots queued before it. Control messages are never dropped, a
+    slave that does not even take those in time is closed.
+
+    With a `mirror`, the slave is in state sync mode: it gets no output but diffs
+    of the mirror's screen against the state it was sent last, one at a time and
+    the next one only after it acknowledged the previous one. A slow link thus
+    skips intermediate screens instead of falling behind.
+    """
+
+    __slots__ = ("ws", "metrics", "binary", "slave_id", "resync", "task", "queue", "queued_bytes", "wakeup",
+                 "resyncing", "resumed", "traces", "dropped", "resyncs", "writer", "closed",
+                 "mirror", "state_base", "state_seq", "state_changed", "state_acked", "state_sent", "state_bytes",
+                 "state_rtt", "state_task")
+
+    def __init__(self, ws, binary, slave_id=None, resync=None, metrics=None, mirror=None):
+        self.ws = ws
+        self.metrics = metrics
+        self.binary = binary
+        self.slave_id = slave_id
+        self.resync = resync
+        self.task = None
+        self.queue = deque()
+        self.queued_bytes = 0
+        self.wakeup = asyncio.Event()
+        self.resyncing = False
+        self.resumed = False
+        self.traces = {}  # trace id: time the keystroke was forwarded to the master
+        self.dropped = 0
+        self.resyncs = 0
+        self.writer = asyncio.get_event_loop().create_task(self.write_worker())
+        self.closed = False
+        self.mirror = mirror
+        self.state_base = None
+        self.state_seq = 0
+        self.state_changed = asyncio.Event()
+        self.state_acked = asyncio.Event()
+        self.state_acked.set()
+        self.state_sent = 0
+        self.state_bytes = 0
+        self.state_rtt = None  # seconds from sending a diff until its ack, smoothed
+        self.state_task = None
+
+    def send_str(self, text, delta=False):
+        self.enqueue(False, text, delta)
+
+    def send_bytes(self, data, delta=False):
+        self.enqueue(True, data, delta)
+
+    def send_snapshot(self, text):
+        """
+        queues a screen snapshot in place of the output and snapshots queued so
+        far, it contains them. Queued as a delta: dropping it resyncs again.
+        """
+        if self.closed:
+            return
+        self.resyncing = False
+        self.remove_deltas()
+        self.queue.append((False, text, True, time.monotonic()))
+        self.queued_bytes += len(text)
+        self.wakeup.set()
+
+    def enqueue(self, binary, data, delta):
+        if self.closed:
+            return
+        if delta and self.resyncing:
+            self.dropped += 1
+            if self.metrics:
+                self.metrics.dropped += 1
+            return
+        self.queue.append((binary, data, delta, time.monotonic()))
+        self.queued_bytes += len(data)
+        if self.overflowing():
+            if not self.resyncing:
+                self.drop_deltas()
+            if self.overflowing():  # control messages alone
+                print(f"slave: {self.slave_id} not reading, closing")
+                self.abort()
+                return
+        self.wakeup.set()
+
+    def overflowing(self):
+        return len(self.queue) > MAX_QUEUE_MESSAGES or self.queued_bytes > MAX_QUEUE_BYTES
+
+    def remove_deltas(self):
+        kept = deque(msg for msg in self.queue if not msg[2])
+        self.dropped += len(self.queue) - len(kept)
+        if self.metrics:
+            self.metrics.dropped += len(self.queue) - len(kept)
+        self.queue = kept
+        self.queued_bytes = sum(len(msg[1]) for msg in kept)
+
+    def drop_deltas(self):
+        self.remove_deltas()
+        # set first: a resync answered right away enqueues the snapshot from in here
+        self.resyncing = True
+        self.resyncs += 1
+        if self.metrics:
+            self.metrics.resyncs += 1
+        if self.resync:
+            self.resync(self)
+
+    def abort(self):
+        """drops everything queued and closes the websocket, the handler cleans up"""
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = 0
+        self.writer.cancel()
+        asyncio.create_task(self.ws.close())
+
+    def start_state(self):
+        """the slave was sent the mirror's screen, diffs follow from here"""
+        # the screen does not tell the cursor's visibility, the first state does
+        self.state_base = (self.mirror.terminal.buffer.save(), None)
+        self.state_task = asyncio.get_event_loop().create_task(self.state_worker())
+        self.changed()
+
+    def changed(self):
+        self.state_changed.set()
+
+    def ack(self, seq):
+        if seq != self.state_seq or self.state_acked.is_set():
+            return
+        rtt = time.monotonic() - self.state_sent
+        self.state_rtt = rtt if self.state_rtt is None else 0.8 * self.state_rtt + 0.2 * rtt
+        self.state_acked.set()
+
+    async def state_worker(self):
+        while True:
+            await self.state_changed.wait()
+            await self.state_acked.wait()
+            delay = self.state_sent + STATE_INTERVAL - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.state_changed.clear()
+            payload, self.state_base = self.mirror.terminal.state(self.state_base)
+            if payload is None:
+                continue
+            self.state_seq = self.state_seq % 0xffffffff + 1
+            self.state_acked.clear()
+            self.state_sent = time.monotonic()
+            self.state_bytes = len(payload)
+            self.send_bytes(encode_frame(FRAME_STATE, payload, seq=self.state_seq))
+
+    def trace(self, trace):
+        self.traces[trace] = time.monotonic()
+        if len(self.traces) > MAX_TRACES:
+            del self.traces[next(iter(self.traces))]
+
+    def echo(self, echo):
+        """adds the time from forwarding the keystroke until its echo came back"""
+        forwarded = self.traces.pop(echo.get("trace"), None)
+        if forwarded is not None:
+            echo["server_ms"] = (time.monotonic() - forwarded) * 1000
+
+    def stats(self):
+        stats = {"id": self.slave_id,
+                 "queued": len(self.queue),
+                 "queued_bytes": self.queued_bytes,
+                 "dropped": self.dropped,
+                 "resyncs": self.resyncs}
+        if self.mirror:
+            stats["states"] = self.state_seq
+            if self.state_rtt:
+                stats["state_rtt_ms"] = round(self.state_rtt * 1000, 1)
+                stats["state_kbps"] = round(self.state_bytes * 8 / self.state_rtt / 1000, 1)
+        return stats
+
+    async def write_worker(self):
+        while True:
+            if not self.queue:
+                self.wakeup.clear()
+                try:
+                    await self.wakeup.wait()
+                except asyncio.CancelledError:
+                    break
+                continue
+            binary, data, _, queued = self.queue.popleft()
+            self.queued_bytes -= len(data)
+            try:
+                if binary:
+                    await self.ws.send_bytes(data)
+                else:
+                    await self.ws.send_str(data)
+                if self.metrics:
+                    self.metrics.count("slave_out", len(data))
+                    self.metrics.send_latency.observe(time.monotonic() - queued)
+            except asyncio.CancelledError:
+                break
+            except ConnectionResetError:  # the rest would fail the same way
+                print(f"slave: {self.slave_id} connection lost")
+                self.abort()
+                break
+            except Exception:
+                print(traceback.format_exc())
+
+    def close(self):
+        if self.task:
+            self.task.cancel()
+        if self.state_task:
+            self.state_task.cancel()
+        self.writer.cancel()
+
+
+def nolog(_):
+    pass
+
+
+class ClashReplay():
+    """
+    The latest broadcast frames of a session, (seq, frame) oldest first and at most
+    `max_bytes` of them. Everything up to `base` is gone, either evicted or
+    replaced by a snapshot.
+    """
+
+    def __init__(self, max_bytes=REPLAY_BYTES):
+        self.max_bytes = max_bytes
+        self.frames = deque()
+        self.size = 0
+        self.base = 0
+
+    def append(self, seq, data):
+        self.frames.append((seq, data))
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            self.base, evicted = self.frames.popleft()
+            self.size -= len(evicted)
+
+    def reset(self, seq):
+        self.frames.clear()
+        self.size = 0
+        self.base = seq
+
+    def since(self, seq):
+        """frames after seq, None if some of them are gone"""
+        if seq < self.base:
+            return None
+        last = self.frames[-1][0] if self.frames else self.base
+        if seq > last:
+            return None
+        return [data for frame_seq, data in self.frames if frame_seq > seq]
+
+
+class ClashMirror():
+    """
+    Headless emulation of a session's output stream, so clashd can hand joining
+    and lagging slaves a screen snapshot without asking the master.
+
+    Masters that support it announce themselves with {"host": name} and send their
+    size before any output; until both arrived the mirror is not ready and joins
+    are forwarded to the master as before.
+    """
+
+    def __init__(self):
+        self.terminal = ClashTerminal(log=nolog)
+        self.terminal.start(headless=True)
+        self.host = None
+        self.sized = False
+        self.members = {}
+        self.seq = 0  # of the last frame or snapshot fed
+        self.replay = ClashReplay()
+
+    @property
+    def ready(self):
+        return self.host is not None and self.sized
+
+    def feed(self, data):
+        self.terminal.input(data)
+
+    def resize(self, cols, rows):
+        self.sized = True
+        self.terminal.resize(full=False, inner=True, cols=cols - 1, rows=rows - 1)
+
+    def record(self, seq, data):
+        self.seq = seq
+        self.replay.append(seq, data)
+
+    def sync(self, screen, seq=None):
+        if seq is not None:  # anything before the snapshot cannot be replayed anymore
+            self.seq = seq
+            self.replay.reset(seq)
+        if screen["cols"] != self.terminal.cols or screen["rows"] != self.terminal.rows:
+            self.terminal.resize(full=False, inner=True, cols=screen["cols"], rows=screen["rows"])
+        self.terminal.restore(screen)
+
+    def dump(self, compact=False):
+        return self.terminal.dump(compact=compact)
+
+    def init(self, compact=False):
+        return {"screen": self.dump(compact),
+                "host": self.host,
+                "members": list(self.members.values()),
+                "seq": self.seq}
+
+
+class ClashSession():
+    """
+    A master's websocket, its slaves by id and the mirror of its screen.
+
+    Slave ids are handed out in order and not reused while the session lasts
+    (until the 16 bit id space wraps), so a message for a slave that left is
+    dropped instead of reaching whoever joined after it.
+
+    Relayed sessions have the upstream clashd in place of the master, their
+    slaves only watch. Once the last one left, `linger` is the timer ending the
+    subscription unless a slave reconnects first.
+    """
+
+    __slots__ = ("ws", "binary", "mirror", "slaves", "next_id", "relay", "linger")
+
+    def __init__(self, ws, binary, mirror, relay=False):
+        self.ws = ws
+        self.binary = binary
+        self.mirror = mirror
+        self.slaves = {}
+        self.next_id = 0
+        self.relay = relay
+        self.linger = None
+
+    def new_id(self):
+        while self.next_id in self.slaves:
+            self.next_id = (self.next_id + 1) % NOBODY
+        slave_id = self.next_id
+        self.next_id = (self.next_id + 1) % NOBODY
+        return slave_id
+
+    def add(self, slave):
+        self.slaves[slave.slave_id] = slave
+        if self.linger:
+            self.linger.cancel()
+            self.linger = None
+
+    def remove(self, slave):
+        if self.slaves.get(slave.slave_id) is slave:
+            del self.slaves[slave.slave_id]
+
+
+class ClashServer():
+    """
+    With `peers`, the URLs of all clashd nodes (as clients use them, ending in
+    /clash) and `node`, this one's among them, sessions are spread over the
+    nodes: ids are drawn until they hash to this node, slaves connecting to
+    another node are relayed here by it.
+
+    With `relay_of`, the URL of another clashd, sessions unknown here are
+    subscribed to there once and rebroadcast to the slaves connected here until
+    the last of them leaves, relays of relays make a fan-out tree.
+    """
+
+    def __init__(self, peers=None, node=None, relay_of=None):
+        self.app = web.Application()
+        self.app.router.add_get("/clash", self.master_handler)
+        self.app.router.add_get("/clash/{session}", self.slave_handler)
+        self.app.router.add_get("/status", self.status_handler)
+        self.app.router.add_get("/metrics", self.metrics_handler)
+        self.sessions = {}
+        self.metrics = ClashMetrics()
+        self.app.on_startup.append(self.metrics.start)
+        self.app.on_cleanup.append(self.metrics.stop)
+        self.port = None
+        self.worker = 0
+        self.workers = 1
+        self.peers = [peer.rstrip("/") for peer in peers or []]
+        self.node = node.rstrip("/") if node else None
+        if self.peers and self.node not in self.peers:
+            raise ValueError(f"{node} is not one of the peers")
+        self.upstream = relay_of.rstrip("/") if relay_of else None
+        self.subscriptions = {}  # session id: future, True once the relayed session is up
+
+    def run(self, host=None, port=8080, workers=1):
+        """
+        serves on one event loop, or forks `workers` processes sharing the port
+        (SO_REUSEPORT). A session lives in the worker its master connected to,
+        slaves landing on another worker are forwarded to it over a Unix socket.
+        """
+        if workers <= 1:
+            web.run_app(self.app, host=host, port=port)
+            return
+
+        self.port = port
+        self.workers = workers
+        children = []
+        for worker in range(workers):
+            pid = os.fork()
+            if pid == 0:
+                self.worker = worker
+                path = worker_socket(port, worker)
+                if os.path.exists(path):
+                    os.unlink(path)
+                try:
+                    web.run_app(self.app, host=host, port=port, path=path, reuse_port=True,
+                                print=lambda msg: print(f"worker {worker}: {msg}"))
+                finally:
+                    if os.path.exists(path):
+                        os.unlink(path)
+                    os._exit(0)
+            children.append(pid)
+
+        def stop(signum, _):
+            for pid in children:
+                try:
+                    os.kill(pid, signum)
+                except ProcessLookupError:
+                    pass
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)  # the workers get Ctrl-C themselves
+        for _ in children:
+            os.wait()
+
+    def new_session_id(self):
+        while True:
+            session_id = secrets.token_urlsafe(6)
+            if self.peers and session_node(session_id, self.peers) != self.node:
+                continue
+            if self.workers == 1 or session_owner(session_id, self.workers) == self.worker:
+                return session_id
+
+    async def master_handler(self, request):
+        print("master: connected")
+        session_ws = web.WebSocketResponse()
+        await session_ws.prepare(request)
+
+        binary = request.query.get("protocol") == str(PROTOCOL_VERSION)
+        session_id = self.new_session_id()
+        if binary:
+            await session_ws.send_json({"session": session_id, "protocol": PROTOCOL_VERSION})
+        else:
+            await session_ws.send_json({"session": session_id})
+        mirror = ClashMirror()
+        session = ClashSession(session_ws, binary, mirror)
+        self.sessions[session_id] = session
+
+        while True:
+            try:
+                msg = await session_ws.receive()
+                if msg.type == WSMsgType.CLOSE or msg.type == WSMsgType.CLOSED:
+                    break
+                elif msg.type == WSMsgType.ERROR:
+                    break
+                elif msg.type == WSMsgType.TEXT:
+                    self.metrics.count("master_in", len(msg.data))
+                    try:
+                        data = json.loads(msg.data)
+                    except Exception:
+                        self.metrics.json_errors += 1
+                        print(traceback.format_exc())
+                        continue
+
+                    if "host" in data:  # master supports the mirror
+                        mirror.host = data["host"]
+                        continue
+
+                    self.mirror_msg(mirror, data)
+
+                    to = None
+                    if "header" in data:
+                        if "to" in data["header"]:
+                            to = data["header"]["to"]
+                        del data["header"]
+
+                    if to is not None:
+                        slave = session.slaves.get(to)
+                        if slave:
+                            if "echo" in data:
+                                slave.echo(data["echo"])
+                            await self.send_slave(session_id, data, slave_id=to)
+                    else:
+                        await self.send_slave(session_id, data)
+                elif msg.type == WSMsgType.BINARY:
+                    self.metrics.count("master_in", len(msg.data))
+                    try:
+                        frame = decode_frame(msg.data)
+                    except Exception:
+                        print(traceback.format_exc())
+                        continue
+
+                    self.mirror_frame(mirror, msg.data, frame)
+
+                    to = frame[2]
+                    if to != NOBODY:
+                        if to in session.slaves:
+                            await self.send_slave_frame(session_id, msg.data, frame, slave_id=to)
+                    else:
+                        await self.send_slave_frame(session_id, msg.data, frame)
+            except asyncio.CancelledError:
+                pass
+
+        print(f"close: master {session_id}")
+        try:
+            for slave in session.slaves.values():
+                try:
+                    slave.close()
+                except Exception:
+                    print(traceback.format_exc())
+        except Exception:
+            print(traceback.format_exc())
+        del self.sessions[session_id]
+
+        return session_ws
+
+    async def slave_handler(self, request):
+        session_id = request.match_info["session"]
+        if session_id not in self.sessions:
+            if self.peers and FORWARDED not in request.headers:
+                node = session_node(session_id, self.peers)
+                if node != self.node:
+                    return await self.forward(request, f"{node}/{session_id}", headers={FORWARDED: self.node})
+            if self.workers > 1:
+                owner = session_owner(session_id, self.workers)
+                if owner != self.worker:
+                    connector = aiohttp.UnixConnector(path=worker_socket(self.port, owner))
+                    return await self.forward(request, f"http://clashd/clash/{session_id}", connector=connector)
+            if not self.upstream or not await self.subscribe(session_id):
+                raise web.HTTPNotFound()
+        print(f"slave: connected to session {session_id}")
+        slave_ws = web.WebSocketResponse(heartbeat=HEARTBEAT)
+        await slave_ws.prepare(request)
+
+        # the master may leave while the handshake is awaited
+        session = self.sessions.get(session_id)
+        if session is None:
+            print(f"slave: session {session_id} ended during the handshake")
+            await slave_ws.close()
+            return slave_ws
+
+        binary = request.query.get("protocol") == str(PROTOCOL_VERSION)
+        # state sync needs the mirror, masters without it keep streaming output
+        state = binary and request.query.get("state") == "1" and session.mirror.ready
+        if state:
+            await slave_ws.send_json({"protocol": PROTOCOL_VERSION, "state": True})
+        elif binary:
+            await slave_ws.send_json({"protocol": PROTOCOL_VERSION})
+        if self.sessions.get(session_id) is not session:
+            print(f"slave: session {session_id} ended during the handshake")
+            await slave_ws.close()
+            return slave_ws
+
+        async def handler(slave_id):
+            while True:
+                try:
+                    msg = await slave_ws.receive()
+                    if msg.type == WSMsgType.CLOSE or msg.type == WSMsgType.CLOSED:
+                        break
+                    elif msg.type == WSMsgType.ERROR:
+                        break
+                    elif msg.type == WSMsgType.TEXT:
+                        # print(f"master -> slave: {msg.data}")
+                        self.metrics.count("slave_in", len(msg.data))
+                        try:
+                            data = json.loads(msg.data)
+                        except Exception:
+                            self.metrics.json_errors += 1
+                            print(traceback.format_exc())
+                            continue
+
+                        data["header"] = {}
+                        data["header"]["from"] = slave_id
+
+                        if "join" in data:
+                            self.join(session_id, slave_id, data)
+
+                        if session.relay:  # watching only
+                            continue
+
+                        if not await self.send_master(session_id, data):
+                            break
+                    elif msg.type == WSMsgType.BINARY:
+                        self.metrics.count("slave_in", len(msg.data))
+                        try:
+                            frame = decode_frame(msg.data)
+                        except Exception:
+                            print(traceback.format_exc())
+                            continue
+
+                        if frame[0] == FRAME_ACK:
+                            slave.ack(frame[3])
+                            continue
+                        if session.relay:
+                            continue
+                        if frame[0] == FRAME_INPUT and frame[3]:
+                            slave.trace(frame[3])
+                        data = set_sender(msg.data, slave_id)
+                        if not await self.send_master_frame(session_id, data, frame[0], slave_id, frame[4]):
+                            break
+
+                except asyncio.CancelledError:
+                    break
+
+        loop = asyncio.get_event_loop()
+        slave_id = session.new_id()
+        slave = ClashSlaveConnection(slave_ws, binary, slave_id=slave_id,
+                                     resync=functools.partial(self.request_resync, session_id),
+                                     metrics=self.metrics, mirror=session.mirror if state else None)
+        slave.task = loop.create_task(handler(slave_id))
+        resume = request.query.get("resume")
+        if resume is not None and binary and not state:
+            self.resume(session_id, slave, int(resume))
+        session.add(slave)
+
+        try:
+            await slave.task
+        except asyncio.CancelledError:
+            pass
+
+        print(f"close: slave {session_id} {slave_id}")
+        slave.close()
+        session.remove(slave)
+        if session.relay:
+            if not session.slaves and self.sessions.get(session_id) is session:
+                # the last viewer left, kept for it to resume from the replay if it reconnects
+                session.linger = loop.call_later(RELAY_LINGER, self.unsubscribe, session_id, session)
+            return slave_ws
+        data = {}
+        data["header"] = {}
+        data["header"]["from"] = slave_id
+        data["leave"] = True
+        await self.send_master(session_id, data)
+        session.mirror.members.pop(slave_id, None)
+
+        return slave_ws
+
+    async def forward(self, request, url, connector=None, headers=None):
+        """
+        relays a slave to the peer or worker owning its session, messages are
+        passed on as they are
+        """
+        async with aiohttp.ClientSession(connector=connector) as client:
+            try:
+                upstream = await client.ws_connect(url, params=request.query, headers=headers)
+            except Exception as exc:
+                print(f"slave: forwarding to {url} failed: {exc}")
+                raise web.HTTPNotFound()
+            slave_ws = web.WebSocketResponse(heartbeat=HEARTBEAT)
+            await slave_ws.prepare(request)
+            print(f"slave: forwarding to {url}")
+
+            async def relay(source, target):
+                async for msg in source:
+                    if msg.type == WSMsgType.TEXT:
+                        await target.send_str(msg.data)
+                    elif msg.type == WSMsgType.BINARY:
+                        await target.send_bytes(msg.data)
+                    else:
+                        break
+
+            relays = [asyncio.create_task(relay(slave_ws, upstream)), asyncio.create_task(relay(upstream, slave_ws))]
+            try:
+                await asyncio.wait(relays, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                for task in relays:
+                    task.cancel()
+                await upstream.close()
+                await slave_ws.close()
+        return slave_ws
+
+    def unsubscribe(self, session_id, session):
+        """ends a relayed session nobody watched for RELAY_LINGER, the next slave subscribes again"""
+        session.linger = None
+        if session.slaves or self.sessions.get(session_id) is not session:
+            return
+        print(f"relay: {session_id} has no viewers left, unsubscribing")
+        del self.sessions[session_id]
+        del self.subscriptions[session_id]
+        asyncio.create_task(session.ws.close())
+
+    async def subscribe(self, session_id):
+        """returns True once the session is relayed from upstream, False if it is unknown there"""
+        if session_id not in self.subscriptions:
+            self.subscriptions[session_id] = asyncio.get_event_loop().create_future()
+            asyncio.create_task(self.relay_worker(session_id))
+        return await asyncio.shield(self.subscriptions[session_id])
+
+    async def relay_worker(self, session_id):
+        """
+        one slave connection upstream: its output feeds the local mirror (and so
+        the replay for resuming slaves) and is broadcast to the local slaves
+        """
+        ready = self.subscriptions[session_id]
+        mirror = ClashMirror()
+        member_ids = itertools.count()
+        session = None
+        try:
+            async with aiohttp.ClientSession() as client:
+                try:
+                    upstream = await client.ws_connect(f"{self.upstream}/{session_id}", params={"protocol": PROTOCOL_VERSION})
+                    await upstream.send_str(json.dumps({"join": f"relay@{socket.gethostname()}"}))
+                except Exception as exc:
+                    print(f"relay: {session_id} not available upstream: {exc}")
+                    return
+                print(f"relay: subscribed to {session_id}")
+                session = ClashSession(upstream, True, mirror, relay=True)
+
+                async for msg in upstream:
+                    if msg.type == WSMsgType.TEXT:
+                        self.metrics.count("master_in", len(msg.data))
+                        try:
+                            data = json.loads(msg.data)
+                        except Exception:
+                            self.metrics.json_errors += 1
+                            print(traceback.format_exc())
+                            continue
+                        if "init" in data:
+                            init = data["init"]
+                            mirror.host = init.get("host")
+                            mirror.sized = True
+                            mirror.sync(init["screen"], init.get("seq", 0))
+                            mirror.members = {next(member_ids): member for member in init.get("members", [])}
+                            if not ready.done():
+                                self.sessions[session_id] = session
+                                ready.set_result(True)
+                            continue
+                        if not ready.done():  # before the screen, already part of it
+                            continue
+                        if "sync" in data:
+                            mirror.sync(data["sync"], data.get("seq"))
+                        elif "welcome" in data:
+                            mirror.members[next(member_ids)] = data["welcome"]
+                        elif "leave" in data:
+                            for key, member in list(mirror.members.items()):
+                                if member == data["leave"]:
+                                    del mirror.members[key]
+                                    break
+                        elif "output" in data or "resize" in data:
+                            # a master without binary framing, numbered here so the local slaves can resume
+                            if "output" in data:
+                                frame_type, payload = FRAME_OUTPUT, base64.b64decode(data["output"])
+                            else:
+                                frame_type, payload = FRAME_RESIZE, RESIZE.pack(*data["resize"])
+                            data = encode_frame(frame_type, payload, seq=mirror.seq + 1)
+                            frame = decode_frame(data)
+                            self.mirror_frame(mirror, data, frame)
+                            await self.send_slave_frame(session_id, data, frame)
+                            continue
+                        else:  # protocol, echoes of the relay's keystrokes (none)
+                            continue
+                        await self.send_slave(session_id, data)
+                    elif msg.type == WSMsgType.BINARY:
+                        self.metrics.count("master_in", len(msg.data))
+                        try:
+                            frame = decode_frame(msg.data)
+                        except Exception:
+                            print(traceback.format_exc())
+                            continue
+                        self.mirror_frame(mirror, msg.data, frame)
+                        if ready.done() and frame[2] == NOBODY:
+                            await self.send_slave_frame(session_id, msg.data, frame)
+                    else:
+                        break
+        except Exception:
+            print(traceback.format_exc())
+        finally:
+            print(f"relay: {session_id} ended upstream")
+            if self.subscriptions.get(session_id) is ready:
+                del self.subscriptions[session_id]
+            if not ready.done():
+                ready.set_result(False)
+            if session and session.linger:
+                session.linger.cancel()
+            if session and self.sessions.get(session_id) is session:
+                del self.sessions[session_id]
+                for slave in session.slaves.values():
+                    slave.close()
+
+    async def send_master(self, session_id, data):
+        if session_id not in self.sessions:
+            return False
+        try:
+            text = json.dumps(data)
+            await self.sessions[session_id].ws.send_str(text)
+            self.metrics.count("master_out", len(text))
+        except Exception:
+            print(traceback.format_exc())
+        return True
+
+    async def send_master_frame(self, session_id, data, frame_type, slave_id, payload):
+        if session_id not in self.sessions:
+            return False
+        session = self.sessions[session_id]
+        try:
+            if session.binary:
+                await session.ws.send_bytes(data)
+            else:
+                data = json.dumps(frame_to_json(frame_type, slave_id, payload))
+                await session.ws.send_str(data)
+            self.metrics.count("master_out", len(data))
+        except Exception:
+            print(traceback.format_exc())
+        return True
+
+    def mirror_msg(self, mirror, data):
+        try:
+            if "output" in data:
+                mirror.feed(base64.b64decode(data["output"]))
+            elif "resize" in data:
+                mirror.resize(*data["resize"])
+            elif "sync" in data:
+                mirror.sync(data["sync"], data.get("seq"))
+            elif "init" in data:  # the master's screen, a legacy slave gets it from the mirror
+                mirror.sync(data["init"]["screen"])
+        except Exception:
+            print(traceback.format_exc())
+
+    def mirror_frame(self, mirror, data, frame):
+        frame_type, _, to, seq, payload = frame
+        try:
+            if frame_type == FRAME_OUTPUT:
+                mirror.feed(payload)
+            elif frame_type == FRAME_RESIZE:
+                mirror.resize(*RESIZE.unpack(payload))
+            if to == NOBODY and frame_type in (FRAME_OUTPUT, FRAME_RESIZE):
+                mirror.record(seq, data)
+        except Exception:
+            print(traceback.format_exc())
+
+    def join(self, session_id, slave_id, data):
+        """answers a join from the mirror, the master is only told about the new member"""
+        session = self.sessions[session_id]
+        mirror = session.mirror
+        slave = session.slaves.get(slave_id)
+        if slave and not slave.binary and session.binary and not session.relay:
+            # cannot load syncs: the master answers, after leaving fast forward for it
+            data["legacy"] = True
+            if mirror.ready:
+                mirror.members[slave_id] = data["join"]
+            return
+        if not mirror.ready:
+            return
+        # the master's welcome adds the new member on the slave
+        if slave:
+            if slave.resumed:  # the screen is up to date already
+                msg = {"resumed": {"host": mirror.host, "members": list(mirror.members.values())}}
+            else:
+                msg = {"init": mirror.init(compact=slave.binary)}
+            slave.send_str(json.dumps(msg))
+            if slave.mirror and not slave.state_task:
+                slave.start_state()
+        if session.relay:  # the members are the upstream session's
+            return
+        mirror.members[slave_id] = data["join"]
+        data["mirrored"] = True
+
+    def resume(self, session_id, slave, seq):
+        """queues the frames a reconnecting slave missed, it gets a snapshot on join if that is not possible"""
+        mirror = self.sessions[session_id].mirror
+        if not mirror.ready:
+            return
+        frames = mirror.replay.since(seq)
+        if frames is None:
+            print(f"slave: {session_id} {slave.slave_id} cannot resume from {seq}")
+            return
+        print(f"slave: {session_id} {slave.slave_id} resuming from {seq}, {len(frames)} frames")
+        for data in frames:
+            slave.send_bytes(data, True)
+        slave.resumed = True
+
+    def request_resync(self, session_id, slave):
+        if session_id not in self.sessions:
+            return
+        print(f"slave: {session_id} {slave.slave_id} too far behind, resyncing")
+        if not slave.binary:  # slaves from before binary framing cannot load a sync
+            slave.abort()
+            return
+        mirror = self.sessions[session_id].mirror
+        if mirror.ready:
+            slave.send_snapshot(json.dumps({"sync": mirror.dump(compact=True), "seq": mirror.seq}))
+            return
+        if not self.sessions[session_id].binary:  # masters without binary framing do not know resync
+            slave.abort()
+            return
+        data = {"resync": True, "header": {"from": slave.slave_id}}
+        asyncio.create_task(self.send_master(session_id, data))
+
+    async def status_handler(self, request):
+        # session ids are join tokens, keep them out
+        sessions = [{"binary": session.binary, "slaves": [slave.stats() for slave in session.slaves.values()]}
+                    for session in self.sessions.values()]
+        return web.json_response({"sessions": sessions})
+
+    async def metrics_handler(self, request):
+        return web.Response(text=self.metrics.render(self.sessions), content_type="text/plain", charset="utf-8")
+
+    async def send_slave_frame(self, session_id, data, frame, slave_id=None):
+        frame_type, sender, _, _, payload = frame
+        text = None  # JSON fallback for slaves without binary frames, encoded once
+
+        slaves = self.sessions[session_id].slaves
+        if slave_id is None:
+            slaves = slaves.values()
+        else:
+            slaves = [slaves[slave_id]]
+
+        delta = frame_type == FRAME_OUTPUT
+        for slave in slaves:
+            try:
+                if slave.mirror:
+                    slave.changed()
+                elif slave.binary:
+                    slave.send_bytes(data, delta)
+                else:
+                    if text is None:
+                        text = json.dumps(frame_to_json(frame_type, sender, payload))
+                    slave.send_str(text, delta)
+            except Exception:
+                print(traceback.format_exc())
+
+    async def send_slave(self, session_id, data, slave_id=None):
+        try:
+            text = json.dumps(data)
+            legacy = None  # packed snapshots are only understood with binary framing
+            session = self.sessions[session_id]
+            if slave_id is None:
+                slaves = session.slaves.values()
+            else:
+                slaves = [session.slaves[slave_id]]
+            for slave in slaves:
+                if slave.mirror and ("output" in data or "resize" in data or "sync" in data):
+                    slave.changed()
+                elif "sync" in data:
+                    if slave.binary:
+                        slave.send_snapshot(text)
+                    elif session.relay:  # the master does not know it is watching and keeps fast forwarding
+                        slave.abort()
+                    # otherwise the master's init for it is still to come, it covers the sync
+                elif "init" in data and not slave.binary and "snapshot" in data["init"].get("screen", {}):
+                    if legacy is None:
+                        legacy = json.dumps({"init": dict(data["init"], screen=session.mirror.dump())})
+                    slave.send_str(legacy, False)
+                else:
+                    slave.send_str(text, "output" in data)
+        except Exception:
+            print(traceback.format_exc())
@@ -8,38 +8,75 @@ import asyncio
 import struct
 import termios
 
+from collections import deque
+
+PTY_READ_MIN = 1024       # bytes per read, doubled while reads fill it
+PTY_READ_MAX = 64 * 1024
+WRITE_HIGH_WATER = 256 * 1024  # queued input bytes above which drain() blocks
+WRITE_LOW_WATER = 64 * 1024    # ... until the queue is back down to this
+
 
 class ClashShell:
 
     def __init__(self, log=None):
         self.log = log
         self.up = True
+        self.write_queue = deque()  # input the PTY did not take yet, oldest first
+        self.write_queued = 0
+        self.drained = asyncio.Event()
+        self.drained.set()
 
     async def start(self, terminal_handler, columns, lines):
         self.columns = columns
         self.lines = lines
         self.open_shell()
 
-        async def handler():
-            reader = asyncio.StreamReader()
-            protocol = asyncio.StreamReaderProtocol(reader)
-            await asyncio.get_running_loop().connect_read_pipe(lambda: protocol, self.p_out)
+        loop = asyncio.get_event_loop()
+        loop.create_task(self.pump(terminal_handler))
+
+    async def pump(self, terminal_handler):
+        """
+        reads the PTY straight into one reusable buffer, the read size adapts to
+        the output rate: doubled while reads fill it, halved while they stay small
+        """
+        loop = asyncio.get_running_loop()
+        view = memoryview(bytearray(PTY_READ_MAX))
+        size = PTY_READ_MIN
+        readable = asyncio.Event()
+        loop.add_reader(self.master_fd, readable.set)
+        try:
             while self.up:
-                try:
-                    data = await reader.read(1024)
-                except Exception:
-                    await terminal_handler(None)
-                    self.up = False
-                    break
+                await readable.wait()
+                readable.clear()
+                # the PTY hands out a few KB per read, keep reading until size is filled or it runs dry
+                length = 0
+                eof = False
+                while length < size:
+                    try:
+                        count = os.readv(self.master_fd, [view[length:size]])
+                    except BlockingIOError:
+                        break
+                    except OSError:  # EIO once the shell is gone
+                        count = 0
+                    if not count:
+                        eof = True
+                        break
+                    length += count
 
-                await terminal_handler(data)
-                if not data:
+                if length:
+                    if length == size and size < PTY_READ_MAX:
+                        size *= 2
+                    elif length < size // 4 and size > PTY_READ_MIN:
+                        size //= 2
+                    # downstream keeps chunks (pending emulation, queues), so they get their own copy
+                    await terminal_handler(bytes(view[:length]))
+                if eof:
+                    await terminal_handler(None)
                     self.up = False
                     break
-            self.log("shell: terminated")
-
-        loop = asyncio.get_event_loop()
-        loop.create_task(handler())
+        finally:
+            loop.remove_reader(self.master_fd)
+        self.log("shell: terminated")
 
     def open_shell(self, command="bash"):
 
@@ -62,10 +99,69 @@ class ClashShell:
         fcntl.fcntl(self.master_fd, fcntl.F_SETFL, orig_fl | os.O_NONBLOCK)
 
     def write(self, data):
-        try:
-            self.p_out.write(data)
-        except Exception:
-            self.up = False
+        """
+        queues input for the shell, written right away while the PTY takes it and
+        from an add_writer callback once it doesn't. Writers that can wait should
+        await drain() afterwards to keep the queue bounded.
+        """
+        if not self.up or not data:
+            return
+        self.write_queue.append(memoryview(data))
+        self.write_queued += len(data)
+        if len(self.write_queue) == 1:
+            self.flush()
+            if self.write_queue:
+                asyncio.get_event_loop().add_writer(self.master_fd, self.flush)
+        if self.write_queued > WRITE_HIGH_WATER:
+            self.drained.clear()
+
+    def interrupt(self, data, discard=False):
+        """
+        writes control characters ahead of the queued input, so ^C and ^Z are not
+        stuck behind a paste. With discard the queued input is dropped as well,
+        including what the PTY took but the shell did not read yet.
+        """
+        if not self.up:
+            return
+        if discard:
+            self.write_queue.clear()
+            self.write_queued = 0
+            try:
+                termios.tcflush(self.master_fd, termios.TCOFLUSH)
+            except termios.error:
+                pass
+        self.write_queue.appendleft(memoryview(data))
+        self.write_queued += len(data)
+        self.flush()
+        if self.write_queue:
+            asyncio.get_event_loop().add_writer(self.master_fd, self.flush)
+
+    def flush(self):
+        while self.write_queue:
+            data = self.write_queue[0]
+            try:
+                written = os.write(self.master_fd, data)
+            except BlockingIOError:  # the tty input buffer is full
+                break
+            except OSError:
+                self.log("shell: write failed")
+                self.up = False
+                self.write_queue.clear()
+                self.write_queued = 0
+                break
+            self.write_queued -= written
+            if written < len(data):
+                self.write_queue[0] = data[written:]
+                break
+            self.write_queue.popleft()
+
+        if not self.write_queue:
+            asyncio.get_event_loop().remove_writer(self.master_fd)
+        if self.write_queued <= WRITE_LOW_WATER:
+            self.drained.set()
+
+    async def drain(self):
+        await self.drained.wait()
 
     def resize(self, cols, rows):
         self.log(f"resize: shell {cols}x{rows}")
@@ -7,25 +7,52 @@ import aiohttp
 import signal
 import functools
 import traceback
+import time
 import os
 
-from .terminal import ClashTerminal
+from .terminal import ClashTerminal, PASTE_START, PASTE_END
+from .latency import ClashLatency
 from .stdin import ClashStdin
+from .protocol import PROTOCOL_VERSION, FRAME_OUTPUT, FRAME_INPUT, FRAME_RESIZE, RESIZE, encode_frame, decode_frame
+from .protocol import FRAME_STATE, FRAME_ACK
+
+RECONNECT_ATTEMPTS = 30  # after the connection to clashd dropped
+RECONNECT_DELAY = 1      # seconds between attempts
+MAX_TRACES = 1024        # keystrokes waiting for their echo
+LATENCY_REPORT = 100     # samples between latency histograms in the debug log
+INPUT_WINDOW = 3         # ms keystrokes are collected after a send before the next one
+INPUT_CHUNK = 64 * 1024  # bytes per input message, pastes are sent in pieces of this size
 
 
 class ClashSlave:
 
-    def __init__(self, log=None, url="http://localhost:8080/clash"):
+    def __init__(self, log=None, url="http://localhost:8080/clash", fps=60, scrollback=0, latency=False,
+                 input_window=INPUT_WINDOW, state_sync=False):
         self.log = log
         self.url = url
         self.up = True
         self.host = ""
-        self.terminal = ClashTerminal(log=log)
+        self.terminal = ClashTerminal(log=log, fps=fps, scrollback=scrollback)
         self.stdin = ClashStdin(log=log)
         self.signal_queue = asyncio.Queue()
         loop = asyncio.get_event_loop()
         self.screen_data_available = loop.create_future()
         self.members = []
+        self.binary = False  # binary frames for terminal I/O, negotiated with clashd
+        self.seq = None  # of the last frame or snapshot seen, to resume from after a reconnect
+        self.state_sync = state_sync  # ask for screen diffs instead of the output
+        self.state = False  # clashd sends screen diffs
+        self.latency = ClashLatency() if latency else None
+        self.trace = 0
+        self.traces = {}  # trace id: time the keystroke was sent
+        self.input_window = input_window / 1000
+        self.input_buffer = bytearray()  # keystrokes waiting for input_worker
+        self.input_ready = asyncio.Event()
+        self.input_drained = asyncio.Event()
+        self.stdin_data = b""  # unprocessed stdin, may end in part of a paste marker
+        self.stdin_timer = None  # lets a held back partial paste start through if nothing follows
+        self.paste = None  # bytearray while a bracketed paste is coming in
+        self.paste_markers = False
 
     async def run(self, session_id):
 
@@ -62,7 +89,7 @@ class ClashSlave:
         for signame in {'SIGINT', 'SIGTERM', 'SIGTSTP', 'SIGWINCH'}:
             loop.add_signal_handler(getattr(signal, signame), functools.partial(sig_handler, signame, self.signal_queue))
 
-        self.terminal.start(self.cols, self.rows, session_id=session_id)
+        self.terminal.start(self.cols, self.rows, session_id=session_id, bracketed_paste=True)
         self.terminal.restore(self.scrinit)
         self.log(self.members)
 
@@ -70,6 +97,7 @@ class ClashSlave:
 
         self.log("stdin: starting")
         await self.stdin.start(self.handle_stdin, hotkey_handler=self.hotkey_handler)
+        input_task = asyncio.create_task(self.input_worker())
 
         self.log("idle loop")
         while self.up and self.stdin.up:
@@ -77,6 +105,7 @@ class ClashSlave:
 
         self.log("stdin: stopping...")
         await self.stdin.stop()
+        input_task.cancel()
         self.log("slave: stopping...")
         await self.stop_slave_worker()
         self.log("terminal: stopping...")
@@ -85,33 +114,69 @@ class ClashSlave:
         print("[exited]")
 
     async def init_slave_connection(self, session_id):
-        url = f"{self.url}/{session_id}"
+        self.session_id = session_id
         self.master_session = aiohttp.ClientSession()
         try:
-            self.ws = await self.master_session.ws_connect(url)
+            await self.connect()
         except Exception as exc:
             await self.master_session.close()
             print(exc)
             return False
         return True
 
+    async def connect(self):
+        params = {"protocol": PROTOCOL_VERSION}
+        if self.state_sync:
+            params["state"] = 1
+        elif self.binary and self.seq is not None:
+            params["resume"] = self.seq
+        self.ws = await self.master_session.ws_connect(f"{self.url}/{self.session_id}", params=params)
+
+    async def reconnect(self):
+        """returns True once connected again, False if clashd is unreachable or the session ended"""
+        for attempt in range(RECONNECT_ATTEMPTS):
+            await asyncio.sleep(RECONNECT_DELAY)
+            if not self.up:
+                return False
+            try:
+                await self.connect()
+                self.log(f"slave: reconnected, resuming from {self.seq}")
+                return True
+            except aiohttp.WSServerHandshakeError as exc:
+                self.log(f"slave: session gone: {exc}")
+                return False
+            except Exception as exc:
+                self.log(f"slave: reconnect {attempt + 1}: {exc}")
+        return False
+
     async def run_slave_worker(self, loop):
         async def worker():
-            try:
-                await self.ws.send_str(json.dumps({"join": os.environ.get('USER')}))
-            except Exception:
-                self.log(traceback.format_exc())
             while self.up:
-                msg = await self.ws.receive()
-                if msg.type == aiohttp.WSMsgType.TEXT:
-                    try:
-                        if not await self.handle_slave_msg(msg.data):
-                            break
-                    except Exception:
-                        self.log(traceback.format_exc())
-                elif msg.type == aiohttp.WSMsgType.CLOSED:
+                try:
+                    await self.ws.send_str(json.dumps({"join": os.environ.get('USER')}))
+                except Exception:
+                    self.log(traceback.format_exc())
+                while self.up:
+                    msg = await self.ws.receive()
+                    if msg.type == aiohttp.WSMsgType.TEXT:
+                        try:
+                            if not await self.handle_slave_msg(msg.data):
+                                break
+                        except Exception:
+                            self.log(traceback.format_exc())
+                    elif msg.type == aiohttp.WSMsgType.BINARY:
+                        try:
+                            await self.handle_slave_frame(msg.data)
+                        except Exception:
+                            self.log(traceback.format_exc())
+                    elif msg.type == aiohttp.WSMsgType.CLOSED:
+                        break
+                    elif msg.type == aiohttp.WSMsgType.ERROR:
+                        break
+                if not self.up:
                     break
-                elif msg.type == aiohttp.WSMsgType.ERROR:
+                self.log("slave: connection lost")
+                if not await self.reconnect():
                     break
             self.up = False
             await self.ws.close()
@@ -124,18 +189,36 @@ class ClashSlave:
 
     async def handle_slave_msg(self, msg):
         data = json.loads(msg)
-        if "init" in data:
+        if "protocol" in data:
+            self.binary = data.get("protocol") == PROTOCOL_VERSION
+            self.state = data.get("state", False)
+            self.log(f"binary: {self.binary} state sync: {self.state}")
+        elif "init" in data:
             initdata = data.get("init")
             self.host = initdata.get("host")
             self.log(f"host: {self.host}")
+            self.seq = initdata.get("seq")
+            self.members = initdata.get('members')
+            if self.screen_data_available.done():  # rejoined after a reconnect
+                self.restore(initdata.get("screen"))
+                self.set_title()
+                return True
             self.scrinit = initdata.get("screen")
             self.rows = self.scrinit['rows']
             self.cols = self.scrinit['cols']
-            self.members = initdata.get('members')
             self.screen_data_available.set_result(True)
+        elif "resumed" in data:  # reconnected, clashd replayed the missed output
+            self.host = data["resumed"].get("host")
+            self.members = data["resumed"].get("members")
+            self.set_title()
         elif "output" in data:
             data = base64.b64decode(data.get("output"))
             self.terminal.input(data)
+        elif "sync" in data:  # snapshot while the master fast forwards an output burst
+            self.seq = data.get("seq")
+            self.restore(data.get("sync"))
+        elif "echo" in data:  # the output of a traced keystroke went out
+            self.handle_echo(data["echo"])
         elif "welcome" in data:
             self.log(data)
             member = data.get("welcome")
@@ -153,9 +236,131 @@ class ClashSlave:
             self.log(f"cmd: unhandled command {data.keys()}")
         return True
 
+    def restore(self, screen):
+        if screen["cols"] != self.terminal.cols or screen["rows"] != self.terminal.rows:
+            self.terminal.resize(full=False, inner=True, cols=screen["cols"], rows=screen["rows"])
+        self.terminal.restore(screen)
+
+    async def handle_slave_frame(self, frame):
+        frame_type, _, _, seq, payload = decode_frame(frame)
+        if frame_type == FRAME_STATE:  # seq numbers the states, not the output
+            self.terminal.load_state(payload)
+            self.cols, self.rows = self.terminal.cols + 1, self.terminal.rows + 1
+            await self.ws.send_bytes(encode_frame(FRAME_ACK, b"", seq=seq))
+            return
+        self.seq = seq
+        if frame_type == FRAME_OUTPUT:
+            self.terminal.input(payload)
+        elif frame_type == FRAME_RESIZE:
+            self.cols, self.rows = RESIZE.unpack(payload)
+            self.terminal.resize(full=False, inner=True, cols=self.cols - 1, rows=self.rows - 1)
+        else:
+            self.log(f"frame: unhandled type {frame_type}")
+
+    def handle_echo(self, echo):
+        sent = self.traces.pop(echo.get("trace"), None)
+        if sent is None or not self.latency:
+            return
+        self.latency.add((time.monotonic() - sent) * 1000, echo.get("server_ms"), echo.get("master_ms"))
+        self.terminal.set_status(self.latency.status())
+        if self.latency.count % LATENCY_REPORT == 0:
+            for line in self.latency.report():
+                self.log(line)
+
+    def next_trace(self):
+        self.trace = self.trace % 0xffffffff + 1
+        self.traces[self.trace] = time.monotonic()
+        if len(self.traces) > MAX_TRACES:  # keystrokes without output
+            del self.traces[next(iter(self.traces))]
+        return self.trace
+
     async def handle_stdin(self, data):
+        if self.terminal.scrolling:
+            self.terminal.scroll_key(data)
+            return
+        if self.stdin_timer:
+            self.stdin_timer.cancel()
+            self.stdin_timer = None
+        data = self.stdin_data + data
+        self.stdin_data = b""
+        while data:
+            if self.paste is None:
+                start = data.find(PASTE_START)
+                if start < 0:
+                    # a marker split across reads is completed by the next one
+                    for length in range(len(PASTE_START) - 1, 1, -1):
+                        if data.endswith(PASTE_START[:length]):
+                            data, self.stdin_data = data[:-length], data[-length:]
+                            self.stdin_timer = asyncio.get_event_loop().call_later(
+                                self.input_window or INPUT_WINDOW / 1000, self.flush_stdin)
+                            break
+                    self.input_buffer += data
+                    break
+                self.input_buffer += data[:start]
+                data = data[start + len(PASTE_START):]
+                # the markers go through only if the program on the master's side asked for them
+                self.paste_markers = self.terminal.dec_bracketed_paste_mode
+                self.paste = bytearray(PASTE_START if self.paste_markers else b"")
+            else:
+                end = data.find(PASTE_END)
+                if end < 0:
+                    for length in range(len(PASTE_END) - 1, 0, -1):
+                        if data.endswith(PASTE_END[:length]):
+                            data, self.stdin_data = data[:-length], data[-length:]
+                            break
+                    self.paste += data
+                    self.paste_chunks()
+                    break
+                self.paste += data[:end]
+                data = data[end + len(PASTE_END):]
+                self.paste_chunks(done=True)
+        if self.input_buffer:
+            self.input_ready.set()
+        if len(self.input_buffer) > INPUT_CHUNK:  # stop reading stdin until the paste went out
+            self.input_drained.clear()
+            await self.input_drained.wait()
+
+    def flush_stdin(self):
+        """sends a held back partial paste start, it was a key sequence after all"""
+        self.stdin_timer = None
+        self.input_buffer += self.stdin_data
+        self.stdin_data = b""
+        self.input_ready.set()
+
+    def paste_chunks(self, done=False):
+        """moves a bracketed paste to the input buffer in INPUT_CHUNK pieces, all of it once done"""
+        while len(self.paste) >= INPUT_CHUNK:
+            self.input_buffer += self.paste[:INPUT_CHUNK]
+            del self.paste[:INPUT_CHUNK]
+        if done:
+            self.input_buffer += self.paste
+            if self.paste_markers:
+                self.input_buffer += PASTE_END
+            self.paste = None
+
+    async def input_worker(self):
+        """
+        sends input as soon as it arrives while idle, anything typed within
+        input_window after a send goes out together with the next one
+        """
+        while self.up:
+            await self.input_ready.wait()
+            self.input_ready.clear()
+            data = bytes(self.input_buffer)
+            self.input_buffer.clear()
+            self.input_drained.set()
+            for i in range(0, len(data), INPUT_CHUNK):
+                await self.send_input(data[i:i + INPUT_CHUNK])
+            if self.input_window:
+                await asyncio.sleep(self.input_window)
+
+    async def send_input(self, data):
         try:
-            await self.ws.send_str(json.dumps({"input": base64.b64encode(data).decode()}))
+            if self.binary:
+                trace = self.next_trace() if self.latency else 0
+                await self.ws.send_bytes(encode_frame(FRAME_INPUT, data, seq=trace))
+            else:
+                await self.ws.send_str(json.dumps({"input": base64.b64encode(data).decode()}))
         except Exception:
             self.log(traceback.format_exc())
 
@@ -163,6 +368,8 @@ class ClashSlave:
         if key == b'd':  # Ctrl-A d
             self.up = False
             await self.stdin.stop()
+        elif key == b'[':  # Ctrl-A [
+            self.terminal.scroll_mode(True)
         else:
             self.log(f"unknown hotkey '{key}'")
 
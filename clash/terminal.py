@@ -1,21 +1,66 @@
 #!/usr/bin/python3
 
+import asyncio
+import base64
 import curses
 import curses.panel
+import functools
 import re
-import traceback
+import sys
+import time
+
+from array import array
+from itertools import groupby
 
 from struct import pack, unpack
 from fcntl import ioctl
 from termios import TIOCGWINSZ
 
+from .parser import ClashParser, GROUND
+from .screen import ClashScreen, ClashScrollback, DIFF_HEADER, pack_attr, unpack_attr
+from .protocol import STATE, STATE_CURSOR_VISIBLE, STATE_BRACKETED_PASTE
+from .screen import A_BOLD, A_DIM, A_ITALIC, A_UNDERLINE, A_BLINK, A_REVERSE, A_STANDOUT
+
+CONTROL = re.compile("[\x00-\x1f]")
+
+# bracketed paste markers, https://cirw.in/blog/bracketed-paste
+PASTE_START = b"\x1b[200~"
+PASTE_END = b"\x1b[201~"
+
+# keys in scroll mode
+SCROLL_KEYS = {b"\x1b[A": "up", b"k": "up",
+               b"\x1b[B": "down", b"j": "down",
+               b"\x1b[5~": "page up", b"b": "page up",
+               b"\x1b[6~": "page down", b" ": "page down",
+               b"g": "top", b"G": "bottom",
+               b"q": "quit", b"\x1b": "quit"}
+
+CURSES_FLAGS = ((A_BOLD, curses.A_BOLD),
+                (A_DIM, curses.A_DIM),
+                (A_ITALIC, curses.A_ITALIC),
+                (A_UNDERLINE, curses.A_UNDERLINE),
+                (A_BLINK, curses.A_BLINK),
+                (A_REVERSE, curses.A_REVERSE),
+                (A_STANDOUT, curses.A_STANDOUT))
+
+
+def legacy_flags(cattr):
+    """packed attribute flags of curses attributes"""
+    flags = 0
+    for flag, curses_flag in CURSES_FLAGS:
+        if cattr & curses_flag:
+            flags |= flag
+    return flags
+
 
 class ClashTerminal:
 
-    def __init__(self, log=None, shell_input=None):
+    def __init__(self, log=None, shell_input=None, fps=60, scrollback=0):
         self.log = log
         self.shell_input = shell_input
-        self.remainder = ""
+        self.fps = fps  # refresh rate cap, 0: once per event loop iteration
+        self.refresh_handle = None
+        self.last_refresh = 0
         self.flags = 0
         self.cols = 0
         self.rows = 0
@@ -31,17 +76,95 @@ class ClashTerminal:
         self.less_rows = None
         self.less_cols = None
         self.title = " clash "
+        self.status = ""
         self.cursor_visible = True
+        self.buffer = ClashScreen()
+        self.screen = None
+        self.pad = None
+        self.curses_attrs = {}
+        self.cursor_shown = None
+        self.savedbuffer = None
+        self.margin_top = 1
+        self.margin_bottom = 0
+        self.scrollback = ClashScrollback(scrollback)
+        self.scrolling = False
+        self.scroll_offset = 0  # lines scrolled back while scrolling
 
         # dec
         self.dec_bracketed_paste_mode = False
+        self.bracketed_paste = False
 
         # vt100
         self.saved_row = self.row
         self.saved_col = self.col
 
-    def start(self, cols=0, rows=0, session_id=" clash "):
+        self.parser = self.init_parser()
+
+    def init_parser(self):
+        # https://espterm.github.io/docs/VT100%20escape%20codes.html
+        # https://man7.org/linux/man-pages/man4/console_codes.4.html
+        # https://xtermjs.org/docs/api/vtfeatures/
+        # https://invisible-island.net/xterm/ctlseqs/ctlseqs.html
+        # sequences not listed here end up in ansi_unhandled
+
+        csi = {
+                "m": self.ansi_color,
+                "?c": self.ansi_cursor_type,
+                "r": self.ansi_set_margin,
+                "n": self.ansi_report,
+                "d": self.ansi_move_row,
+                "?h": functools.partial(self.dec_private_modes, val=True),
+                "?l": functools.partial(self.dec_private_modes, val=False),
+                "h": functools.partial(self.csi_set_mode, val=True),
+                "l": functools.partial(self.csi_set_mode, val=False),
+                "A": self.ansi_move_up,
+                "B": self.ansi_move_down,
+                "C": self.ansi_move_right,
+                "D": self.ansi_move_left,
+                "G": self.ansi_position_col,
+                "H": self.ansi_position,
+                "f": self.ansi_position,
+                "J": self.ansi_erase,
+                "?J": self.ansi_erase,
+                "K": self.ansi_erase_line,
+                "?K": self.ansi_erase_line,
+                "X": self.ansi_erase_chars,
+                "L": self.ansi_insert_lines,
+                "M": self.ansi_append_lines,
+                "P": self.ansi_delete_chars,
+                "S": self.ansi_scroll_up,
+                "@": self.insert_chars,  # CSI Ps @  Insert Ps (Blank) Character(s) (default = 1) (ICH).
+                ">c": self.ansi_secondary_device,
+        }
+
+        esc = {
+                "7": self.esc_code,
+                "8": self.esc_code,
+                "M": self.esc_reverse_index,  # https://www.aivosto.com/articles/control-characters.html
+                "=": self.ansi_keypad,
+                ">": self.ansi_keypad,
+                "(": self.ansi_charset,  # (0 Select VT100 graphics mapping
+        }
+
+        osc = {
+                0: self.xterm_set_window_title,
+        }
+
+        return ClashParser(self.puts, csi, esc, osc, self.ansi_unhandled, log=self.log)
+
+    def start(self, cols=0, rows=0, session_id=" clash ", headless=False, bracketed_paste=False):
         self.session_id = session_id
+        if headless:
+            # emulation only, nothing is rendered
+            self.cols = cols
+            self.rows = rows
+            self.width = self.cols + 1
+            self.height = self.rows + 1
+            self.buffer.resize(self.cols, self.rows)
+            self.margin_top = 1
+            self.margin_bottom = self.rows
+            return self.cols, self.rows
+
         self.screen = curses.initscr()
 
         self.height, self.width = self.screen.getmaxyx()
@@ -52,6 +175,7 @@ class ClashTerminal:
             self.cols = cols
             self.rows = rows
         self.log(f"terminal: starting {self.cols}x{self.rows} ({self.width} {self.height})")
+        self.buffer.resize(self.cols, self.rows)
         self.pad = curses.newpad(self.rows, self.cols + 1)  # 1 more column to allow printing to the last bottom right character
 
         curses.noecho()
@@ -60,8 +184,7 @@ class ClashTerminal:
         self.screen.keypad(1)
         self.screen.scrollok(False)
         # curses.mousemask(curses.ALL_MOUSE_EVENTS | curses.REPORT_MOUSE_POSITION)
-        self.refresh()
-        self.margin_top = 0
+        self.margin_top = 1
         self.margin_bottom = self.rows
 
         curses.start_color()
@@ -71,12 +194,26 @@ class ClashTerminal:
             curses.endwin()
             raise Exception("Error: ncurses cannot change color! Please export TERM=xterm-256color")
 
+        # the outer terminal marks pastes with PASTE_START/PASTE_END on stdin
+        self.bracketed_paste = bracketed_paste
+        if bracketed_paste:
+            sys.stdout.write("\x1b[?2004h")
+            sys.stdout.flush()
+
         self.update_border()
         self.refresh()
         return self.cols, self.rows
 
     def stop(self):
+        if not self.screen:
+            return
         self.log("terminal: terminating...")
+        if self.refresh_handle:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
+        if self.bracketed_paste:
+            sys.stdout.write("\x1b[?2004l")
+            sys.stdout.flush()
         curses.nocbreak()
         self.screen.keypad(False)
         curses.echo()
@@ -84,9 +221,8 @@ class ClashTerminal:
         self.log("terminal: terminated")
 
     def update_border(self):
-        old_color_fg = self.color_fg
-        old_color_bg = self.color_bg
-        old_flags = self.flags
+        if not self.screen:
+            return
 
         row = self.rows
         col = self.cols
@@ -109,41 +245,35 @@ class ClashTerminal:
         if self.less_rows and self.less_cols:
             corner = "↘"
 
-        self.color_fg = 69
-        self.color_bg = 0
-        self.flags = 0
-        curses.curs_set(0)
+        color = self.curses_attr(pack_attr(69, 0, 0))
 
-        self.screen.addstr(row, 0, bottom * 2, self.get_color())
-        self.screen.addstr(row, 2, self.title, self.get_color())
+        self.screen.addstr(row, 0, bottom * 2, color)
+        self.screen.addstr(row, 2, self.title, color)
         pos = 2 + len(self.title)
 
         session = f"⟨ {self.session_id} ⟩"
-        self.screen.addstr(row, pos, bottom * (col - len(session) - 7 - len(self.title) - 2), self.get_color())
-        self.screen.addstr(row, col - len(session) - 7, session, self.get_color())
-        self.screen.addstr(row, col - 7, bottom * 7, self.get_color())
+        if self.scrolling:
+            session = f"⟨ scroll {self.scroll_offset}/{len(self.scrollback)} ⟩"
+        self.screen.addstr(row, pos, bottom * (col - len(session) - 7 - len(self.title) - 2), color)
+        self.screen.addstr(row, col - len(session) - 7, session, color)
+        status_col = col - len(session) - 8 - len(self.status)
+        if self.status and status_col > pos:
+            self.screen.addstr(row, status_col, self.status, color)
+        self.screen.addstr(row, col - 7, bottom * 7, color)
         for i in range(0, row):
-            self.screen.addstr(i, col, right, self.get_color())
+            self.screen.addstr(i, col, right, color)
         # writing to bottom right corner throws an exception, but works
         try:
-            self.screen.addstr(row, col, corner, self.get_color())
+            self.screen.addstr(row, col, corner, color)
         except Exception:
             pass
         self.border_row = row
         self.border_col = col
 
-        self.color_fg = old_color_fg
-        self.color_bg = old_color_bg
-        self.flags = old_flags
-
-        self.move_cursor(self.row, self.col)
-        curses.curs_set(1)
-
     def linefeed(self):
         if self.row < self.margin_bottom - 1:
             self.row += 1
             # self.log(f"pos: linefeed {self.row}")
-            self.move_cursor(self.row, self.col)
         else:
             self.log("pos: scroll up")
             # firstline = []
@@ -157,9 +287,12 @@ class ClashTerminal:
             self.color_fg = -1
             self.color_bg = -1
 
-            self.pad.scrollok(True)
-            self.pad.scroll()
-            self.pad.scrollok(False)
+            if self.margin_top == 1 and self.savedbuffer is None and self.scrollback.capacity:
+                self.scrollback.push(self.buffer.chars[0], self.buffer.attrs[0])
+                if self.scrolling:  # keep the view where it is
+                    self.scroll_offset = min(self.scroll_offset + 1, len(self.scrollback))
+
+            self.buffer.scroll(self.margin_top - 1, self.margin_bottom, 1)
 
     def puttext(self, text):
         color = self.get_color()
@@ -181,60 +314,46 @@ class ClashTerminal:
             for k in map_linechar_utf8:
                 text = text.replace(k, map_linechar_utf8[k])
 
-        try:
-            self.pad.addstr(self.row, self.col, text[:length], color)
-        except Exception:
-            self.log(f"err: {self.row} {self.col} {bytes(text.encode())}")
+        self.buffer.write(self.row, self.col, text[:length], color)
         self.col += length
 
     def puts(self, msg):
         if not msg:
             return
 
-        text = ""
-        for c in msg:
-            code = ord(c)
-            if code < 32:
-                if text:  # output text before special character
-                    self.puttext(text)
-                    text = ""
-
-                # handle special character
-                if code == 7:  # Bell
-                    self.log("beep")
-                elif code == 8:  # BS
-                    if self.col > 0:
-                        self.col -= 1
-                        self.move_cursor(self.row, self.col)
-                elif code == 9:  # Tab
-                    if self.col < self.cols - 8:
-                        try:
-                            self.pad.addstr(self.row, self.col, "        ", self.get_color())
-                        except Exception:
-                            self.log(f"err: {self.row} {self.col} '        ")
-                        self.col += 8
-                        self.move_cursor(self.row, self.col)
-                elif code == 10:  # LF
-                    # self.log("chr: LF")
-                    self.linefeed()
-                elif code == 13:  # CR
-                    # self.log(f"chr: CR {self.row}")
-                    self.col = 0
-                    self.move_cursor(self.row, self.col)
-                elif code == 15:  # reset font ??
-                    self.flags = 0
-                    self.color_fg = -1
-                    self.color_bg = -1
-
-                else:
-                    self.log(f"todo: unknown ascii {ord(c)}")
-#            if code > 127:
-#                self.log(f"unknown ascii {ord(c)}")
+        pos = 0
+        for m in CONTROL.finditer(msg):
+            start = m.start()
+            if start > pos:  # output text before special character
+                self.puttext(msg[pos:start])
+            pos = start + 1
+
+            # handle special character
+            code = ord(msg[start])
+            if code == 7:  # Bell
+                self.log("beep")
+            elif code == 8:  # BS
+                if self.col > 0:
+                    self.col -= 1
+            elif code == 9:  # Tab
+                if self.col < self.cols - 8:
+                    self.buffer.fill(self.row, self.col, 8, self.get_color())
+                    self.col += 8
+            elif code == 10:  # LF
+                # self.log("chr: LF")
+                self.linefeed()
+            elif code == 13:  # CR
+                # self.log(f"chr: CR {self.row}")
+                self.col = 0
+            elif code == 15:  # reset font ??
+                self.flags = 0
+                self.color_fg = -1
+                self.color_bg = -1
             else:
-                text += c
+                self.log(f"todo: unknown ascii {code}")
 
-        if text:
-            self.puttext(text)
+        if pos < len(msg):
+            self.puttext(msg[pos:])
 
     def set_color(self, params):
 
@@ -264,28 +383,28 @@ class ClashTerminal:
                     self.color_fg = -1
                     self.color_bg = -1
                 elif param == 1:
-                    self.flags |= curses.A_BOLD
+                    self.flags |= A_BOLD
                 elif param == 2:
-                    self.flags |= curses.A_DIM
+                    self.flags |= A_DIM
                 elif param == 3:
-                    self.flags |= curses.A_ITALIC
+                    self.flags |= A_ITALIC
                 elif param == 4:
-                    self.flags |= curses.A_UNDERLINE
+                    self.flags |= A_UNDERLINE
                 elif param == 5:
                     if self.dec_blinking_cursor:
-                        self.flags |= curses.A_BLINK
+                        self.flags |= A_BLINK
                     else:
-                        # self.flags |= curses.A_STANDOUT
+                        # self.flags |= A_STANDOUT
                         self.log("todo: blink with .dec_blinking_cursor false")
                 elif param == 6:
                     self.log("todo: color flag 6")
-                    self.flags |= curses.A_STANDOUT
+                    self.flags |= A_STANDOUT
 
                 elif param == 7:
-                    self.flags |= curses.A_REVERSE
+                    self.flags |= A_REVERSE
 
                 elif param == 27:
-                    self.flags &= ~curses.A_REVERSE
+                    self.flags &= ~A_REVERSE
 
                 elif param >= 30 and param <= 37:
                     self.color_fg = param - 30
@@ -317,178 +436,110 @@ class ClashTerminal:
                 self.color_bg = param
 
     def get_color(self):
-        idx = -1
-        fg = 2  # green
-        bg = 0  # black
-
-        if self.color_fg != -1:
-            fg = self.color_fg
-        if self.color_bg != -1:
-            bg = self.color_bg
-
-        if bg * 256 + fg not in self.colors:
-            idx = len(self.colors)
-            self.log(f"clr: adding {idx}: {fg} {bg}")
-            curses.init_pair(idx + 1, fg, bg)
-            self.colors[bg * 256 + fg] = idx
-        else:
-            idx = self.colors[bg * 256 + fg]
-
-        return curses.color_pair(idx + 1) | self.flags
+        return pack_attr(self.color_fg, self.color_bg, self.flags)
 
     def ansi_unhandled(self, g):
         self.log(f"todo: esc seq '\\x1b{g[0]}'")
 
     def ansi_color(self, g):
         # self.log(f"clr: {g}")
-        params = []
-        for c in g[0].split(";"):
-            v = c.lstrip("0")
-            if v == "":
-                v = "0"
-            params.append(int(v))
-        self.set_color(params)
+        self.set_color(g)
+
+    def ansi_cursor_type(self, g):
+        if g and g[0] == 1:
+            self.ansi_hide_cursor()
+        else:
+            self.ansi_show_cursor()
 
     def ansi_move_up(self, g):
         rows = 1
-        if len(g) > 0:
-            try:
-                rows = int(g[0])
-            except Exception:
-                pass
-        if rows < 1:  # is this an error? \x1b[-1A
-            return
-        self.row -= int(rows)
+        if g and g[0]:
+            rows = g[0]
+        self.row -= rows
         if self.row < 0:
             self.row = 0
         self.log(f"mov: up {rows} rows to {self.row}")
-        self.move_cursor(self.row, self.col)
 
     def ansi_move_down(self, g):
         rows = 1
-        if len(g) > 0:
-            try:
-                rows = int(g[0])
-            except Exception:
-                pass
-        self.row += int(rows)
-        if self.row < 0:
-            self.row = 0
+        if g and g[0]:
+            rows = g[0]
+        self.row += rows
         self.log(f"mov: down {rows} rows to {self.row}")
-        self.move_cursor(self.row, self.col)
 
     def ansi_move_right(self, g):
         cols = 1
-        if len(g) > 0:
-            try:
-                cols = int(g[0])
-            except Exception:
-                pass
+        if g and g[0]:
+            cols = g[0]
         self.log(f"mov: right {cols} from {self.col}")
         self.col += cols
-        self.move_cursor(self.row, self.col)
 
     def ansi_move_left(self, g):
         cols = 1
-        if len(g) > 0:
-            try:
-                cols = int(g[0])
-            except Exception:
-                pass
+        if g and g[0]:
+            cols = g[0]
         self.log(f"mov: left {cols} from {self.col}")
         self.col -= cols
         if self.col < 0:
             self.col = 0
-        self.move_cursor(self.row, self.col)
+
+    def esc_reverse_index(self, g):
+        self.ansi_move_up([])
 
     def insert_chars(self, g):
         num = 1
-        if len(g) > 0:
-            try:
-                num = int(g[0])
-            except Exception:
-                pass
+        if g and g[0]:
+            num = g[0]
         self.log(f"ins: insert {num} chars at {self.col}")
-        for c in range(self.cols - 1, self.col + num - 1, -1):
-            ch = self.pad.inch(self.row, c - num)
-            self.pad.addch(self.row, c, ch)
-        self.pad.addstr(self.row, self.col, " " * num, self.get_color())
+        self.buffer.insert_chars(self.row, self.col, num, self.get_color())
 
     def ansi_delete_chars(self, g):
         num = 1
-        if len(g) > 0:
-            try:
-                num = int(g[0])
-            except Exception:
-                pass
+        if g and g[0]:
+            num = g[0]
         if self.col + num > self.cols:
             num = self.cols - self.col
         self.log(f"era: erase {num} chars from {self.col}")
-        for c in range(self.col + num, self.cols):
-            ch = self.pad.inch(self.row, c)
-            self.pad.addch(self.row, c - num, ch)
-        self.pad.addstr(self.row, self.col + num, " " * num, self.get_color())
-        self.move_cursor(self.row, self.col)
+        self.buffer.delete_chars(self.row, self.col, num, self.get_color())
 
     def ansi_move_row(self, g):
-        row = g[0]
-        self.row = int(row) - 1
+        row = 1
+        if g and g[0]:
+            row = g[0]
+        self.row = row - 1
         self.log(f"row: {self.row}")
-        self.move_cursor(self.row, self.col)
 
     def ansi_position_col(self, g):
         col = 1
-        if len(g) > 0:
-            try:
-                col = int(g[0])
-            except Exception:
-                pass
-        self.col = int(col) - 1
+        if g and g[0]:
+            col = g[0]
+        self.col = col - 1
         self.log(f"col: {self.col}")
-        self.move_cursor(self.row, self.col)
 
     def ansi_insert_lines(self, g):
-        if g[0] == "":
-            count = 1
-        else:
-            count = int(g[0])
+        count = 1
+        if g and g[0]:
+            count = g[0]
 
         self.log(f"ins: {count} lines")
-        blank = " " * self.cols
-        for _ in range(count):
-            self.log("scroll down")
-            self.pad.scrollok(True)
-            self.pad.scroll(-1)
-            self.pad.scrollok(False)
-            try:
-                self.pad.addstr(self.row, 0, blank, self.get_color())
-            except Exception:
-                self.log(f"err: {self.row} 0 ' ' * {self.cols}")
+        self.buffer.scroll(self.row, self.margin_bottom, -count, self.get_color())
 
     def ansi_position(self, g):
-        if len(g) > 1:
-            row, col = g[0:2]
-            self.row = int(row) - 1
-            self.col = int(col) - 1
-        elif len(g) == 1:
-            col = g[0]
-            self.col = int(col) - 1
-
-        if self.row < 0:
-            self.row = 0
-        elif self.row >= self.rows:
+        row = 1
+        col = 1
+        if len(g) > 0 and g[0]:
+            row = g[0]
+        if len(g) > 1 and g[1]:
+            col = g[1]
+        self.row = row - 1
+        self.col = col - 1
+
+        if self.row >= self.rows:
             self.row = self.rows - 1
         # self.log(f"pos: {self.row} {self.col}")
-        try:
-            self.move_cursor(self.row, self.col)
-        except Exception:
-            self.log(f"err: move {self.row} {self.col}")
 
-    def ansi_pos_home(self, g):
-        self.row = 0
-        self.col = 0
-        # self.log(f"pos: {self.row} {self.col}")
-        self.move_cursor(self.row, self.col)
+    def erase_line(self, start, length):
+        self.buffer.fill(self.row, start, length, self.get_color())
 
     def ansi_erase_line(self, g):
         self.log(f"erase line {g}")
@@ -497,109 +548,67 @@ class ClashTerminal:
         # ESC[1K	erase start of line to the cursor
         # ESC[2K	erase the entire line
 
-        param = g[0]
-        variant = g[1]
-
-        if variant == "X":  # erase right with optional length
-            if param is not None:
-                length = int(param)
-            else:
-                length = self.cols - self.col
-            start = self.col
-
-        elif variant == "K":  # erase with different behavior
-            if param == "" or int(param) == 0:  # erase from cursor to end of line
-                length = self.cols - self.col
-                start = self.col
-            elif int(param) == 1:                 # erase start of line to the cursor
-                length = self.col
-                start = 0
-            elif int(param) == 2:                 # erase the entire line
-                length = self.cols
-                start = 0
-
-        blank = " " * length
-        try:
-            # FIXME: should not move cursor, just will text
-            self.pad.addstr(self.row, start, blank, self.get_color())
-            self.move_cursor(self.row, self.col)
-        except Exception:
-            self.log(f"err: {self.row} {start} ' ' * {length}")
+        param = 0
+        if g:
+            param = g[0]
+
+        if param == 0:    # erase from cursor to end of line
+            self.erase_line(self.col, self.cols - self.col)
+        elif param == 1:  # erase start of line to the cursor
+            self.erase_line(0, self.col)
+        elif param == 2:  # erase the entire line
+            self.erase_line(0, self.cols)
+
+    def ansi_erase_chars(self, g):
+        # ESC[nX	erase n characters from the cursor
+        length = 1
+        if g and g[0]:
+            length = g[0]
+        if length > self.cols - self.col:
+            length = self.cols - self.col
+        self.erase_line(self.col, length)
 
     def ansi_erase(self, g):
+        param = 0
+        if g:
+            param = g[0]
+
+        if param == 0:  # J / 0J: erase from cursor until end of screen
+            self.log("erase: until end of screen")
+            color = self.get_color()
+            self.buffer.fill(self.row, self.col, self.cols - self.col, color)
+            for r in range(self.row + 1, self.rows):
+                self.buffer.fill(r, 0, self.cols, color)
+
+        elif param == 1:  # 1J: erase from cursor to beginning of screen
+            self.log("todo: erase scrollback")
+
+        elif param == 2:  # 2J: erase entire screen
+            self.log("erase screen")
+            self.row = 0
+            self.col = 0
+            self.buffer.clear(self.get_color())
 
-        if len(g) > 0:
-            param = 0
-            try:
-                param = int(g[0])
-            except Exception:
-                pass
-            if param == 0:  # J / 0J: erase from cursor until end of screen
-                self.log(f"erase: until end of screen")
-                try:
-                    self.pad.addstr(self.row, self.col, " " * (self.cols - self.col), self.get_color())
-                except Exception:
-                    pass
-                self.row += 1
-                blank = " " * self.cols
-                for r in range(self.row, self.rows):
-                    try:
-                        self.pad.addstr(r, 0, blank, self.get_color())
-                    except Exception:
-                        self.log(f"err: {r} 0 ' ' * {self.cols}")
-
-            elif param == 1:  # 1J: erase from cursor to beginning of screen
-                self.log(f"todo: erase scrollback")
-
-            elif param == 2:  # 2J: erase entire screen
-                self.log(f"erase screen")
-                self.row = 0
-                self.col = 0
-                self.move_cursor(self.row, self.col)
-                blank = " " * self.cols
-                for r in range(self.row, self.rows):
-                    try:
-                        self.pad.addstr(r, 0, blank, self.get_color())
-                    except Exception:
-                        self.log(f"err: {r} 0 ' ' * {self.cols}")
-
-            elif param == 3:  # 3J: erase saved lines / scrollback
-                self.log(f"todo: erase scrollback")
-
-            else:
-                self.log(f"todo: {g}")
-
-        else:  # erase rest of line and screen
-            blank = " " * (self.cols - self.col)
-            try:
-                self.pad.addstr(self.row, self.col, blank, self.get_color())
-            except Exception:
-                self.log(f"err: {self.row} {self.col} ' ' * {self.cols - self.col}")
+        elif param == 3:  # 3J: erase saved lines / scrollback
+            self.log("erase scrollback")
+            self.scrollback.clear()
+            self.scroll_offset = 0
 
-            blank = " " * self.cols
-            for r in range(self.row, self.rows - 1):
-                try:
-                    self.pad.addstr(r, 0, blank, self.get_color())
-                except Exception:
-                    self.log(f"err: {r} 0 ' ' * {self.cols}")
+        else:
+            self.log(f"todo: {g}")
 
     def ansi_hide_cursor(self, *g):
         self.log("cur: hide")
-        curses.curs_set(0)
         self.cursor_visible = False
 
     def ansi_show_cursor(self, *g):
         self.log("cur: show")
-        curses.curs_set(1)
         self.cursor_visible = True
 
     def ansi_report(self, g):
         code = None
-        if len(g) > 0:
-            try:
-                code = int(g[0])
-            except Exception:
-                pass
+        if g:
+            code = g[0]
 
         if code == 6:  # get cursoe pos
             if self.shell_input:
@@ -609,45 +618,49 @@ class ClashTerminal:
             self.log(f"todo: report code {code}")
 
     def ansi_clear_screen(self, g):
-        self.pad.clear()
+        self.buffer.clear()
 
     def ansi_set_margin(self, g):
-        self.margin_top = int(g[0])
-        self.margin_bottom = int(g[1])
-        # FIXME: check negative
-        try:
-            self.pad.setscrreg(self.margin_top - 1, self.margin_bottom - 1)
-        except Exception:
-            pass
+        self.margin_top = 1
+        self.margin_bottom = self.rows
+        if len(g) > 0 and g[0]:
+            self.margin_top = g[0]
+        if len(g) > 1 and g[1]:
+            self.margin_bottom = g[1]
+        if self.margin_bottom > self.rows:
+            self.margin_bottom = self.rows
+        if self.margin_top > self.margin_bottom:
+            self.margin_top = 1
         self.row = self.margin_top - 1
         self.col = 0
-        self.move_cursor(self.row, self.col)
         self.log(f"scroll margin: {self.margin_top} {self.margin_bottom}")
 
     def ansi_scroll_up(self, g):
-        rows = int(g[0])
+        rows = 1
+        if g and g[0]:
+            rows = g[0]
         self.log(f"todo: scroll up: {rows}")
 
     def ansi_append_lines(self, g):
-        count = int(g[0])
+        count = 1
+        if g and g[0]:
+            count = g[0]
         # self.log(f"pos: append {count} lines")
         row_old = self.row
         col_old = self.col
         self.row = self.margin_bottom - 1
         self.col = 0
-        self.move_cursor(self.row, self.col)
         for _ in range(count):
             self.linefeed()
         self.row = row_old
         self.col = col_old
-        self.move_cursor(self.row, self.col)
 
     def ansi_keypad(self, g):
         keypad = g[0]
         if keypad == "=":
-            self.log(f"todo: alternate keypad mode")
+            self.log("todo: alternate keypad mode")
         elif keypad == ">":
-            self.log(f"todo: numkeypad mode")
+            self.log("todo: numkeypad mode")
 
     def ansi_charset(self, g):
         self.log(f"todo: character set {g[0]}")
@@ -657,48 +670,29 @@ class ClashTerminal:
         else:
             self.charset_lines = False
 
-    def csi_set_mode(self, g):
-        opt = g[0]
-        try:
-            opt = int(opt)
-        except Exception:
-            pass
+    def csi_set_mode(self, g, val):
+        for opt in g:
+            if opt == 2:
+                self.log(f"todo: Keyboard Action Mode (KAM) {val}")
 
-        val = False
-        if g[1] == 'h':  # set
-            val = True
-        elif g[1] == 'l':  # reset
-            val = False
+            elif opt == 4:
+                self.log(f"todo: Insert Mode (IRM) {val}")
 
-        if opt == 2:
-            self.log(f"todo: Keyboard Action Mode (KAM) {val}")
+            elif opt == 12:
+                self.log(f"todo: Send/receive (SRM) {val}")
 
-        elif opt == 4:
-            self.log(f"todo: Insert Mode (IRM) {val}")
+            elif opt == 20:
+                self.log(f"todo: Automatic Newline (LNM) {val}")
 
-        elif opt == 12:
-            self.log(f"todo: Send/receive (SRM) {val}")
-
-        elif opt == 20:
-            self.log(f"todo: Automatic Newline (LNM) {val}")
-
-        else:
-            self.log(f"todo: set mode {opt} {val}")
+            else:
+                self.log(f"todo: set mode {opt} {val}")
 
-    def dec_private_modes(self, g):
+    def dec_private_modes(self, g, val):
         # https://terminalguide.namepad.de/mode/
-        opt = g[0]
-        try:
-            opt = int(opt)
-        except Exception:
-            pass
-
-        val = False
-        if g[1] == 'h':  # set
-            val = True
-        elif g[1] == 'l':  # reset
-            val = False
+        for opt in g:
+            self.dec_private_mode(opt, val)
 
+    def dec_private_mode(self, opt, val):
         if opt == 1:
             self.log(f"todo: dec: Application Cursor Keys {val}")
             # https://documentation.help/PuTTY/config-appcursor.html
@@ -729,48 +723,30 @@ class ClashTerminal:
             if val is True:
                 self.savedcol = self.col
                 self.savedrow = self.row
-                self.savedbuffer = []
-                for row in range(0, self.rows):
-                    for col in range(0, self.cols):
-                        c = self.pad.inch(row, col)
-                        self.savedbuffer.append(c)
+                self.savedbuffer = self.buffer.save()
                 self.ansi_erase([2])
-            else:
-                # FIXME: save buffer rows,cols in case of resize
-                for r in range(0, self.rows):
-                    for c in range(0, self.cols):
-                        try:
-                            ch = self.savedbuffer[r * self.cols + c]
-                            self.pad.addch(r, c, ch)
-                        except Exception as exc:
-                            self.log(f"todo: {exc} {r} {c} {ch}")
-                self.savedbuffer = []
+            elif self.savedbuffer:
+                self.buffer.load(self.savedbuffer)
+                self.savedbuffer = None
                 self.col = self.savedcol
                 self.row = self.savedrow
-                self.move_cursor(self.row, self.col)
 
         elif opt == 2004:
-            self.log(f"todo: dec: Set bracketed paste mode {val}")
+            self.log(f"dec: Set bracketed paste mode {val}")
             self.dec_bracketed_paste_mode = val
-            # https://cirw.in/blog/bracketed-paste
 
         else:
             self.log(f"todo: dec {opt} {val}")
 
     def esc_code(self, g):  # vt100 ?
         opt = g[0]
-        try:
-            opt = int(opt)
-        except Exception:
-            pass
-
-        if opt == 7:
-            self.log(f"vt100: save cursor")
+        if opt == "7":
+            self.log("vt100: save cursor")
             self.saved_row = self.row
             self.saved_col = self.col
 
-        elif opt == 8:
-            self.log(f"vt100: restore cursor")
+        elif opt == "8":
+            self.log("vt100: restore cursor")
             self.row = self.saved_row
             self.col = self.saved_col
 
@@ -785,126 +761,119 @@ class ClashTerminal:
     def ansi_secondary_device(self, g):
         self.log("todo: dec: set secondary device attributes")
 
-    def addansi(self, row, col, line):
-        # https://espterm.github.io/docs/VT100%20escape%20codes.html
-        # https://man7.org/linux/man-pages/man4/console_codes.4.html
-        # https://xtermjs.org/docs/api/vtfeatures/
-        # https://invisible-island.net/xterm/ctlseqs/ctlseqs.html
-
-        ansi = {
-                r"\[([;\d]*)m": self.ansi_color,
-
-                r"(\d)": self.esc_code,
-                r"\[;?\?1c": self.ansi_hide_cursor,
-                r"\[;?\?0c": self.ansi_show_cursor,
-                r"(\)0)": self.ansi_unhandled,  # )0 Start / (0 Select VT100 graphics mapping
-                r"\[;?(\d+);(\d+)r": self.ansi_set_margin,
-                r"\[;?(\d+)n": self.ansi_report,
-                r"\[;?(\d+)d": self.ansi_move_row,
-                r"\[;?\?(\d+)([hl])": self.dec_private_modes,
-                r"\[(\d+)([hl])": self.csi_set_mode,
-                r"(\[;??1000l)": self.ansi_unhandled,  # X11 Mouse Reporting
-                r"(\[;??2004h)": self.ansi_unhandled,
-                r"(\[;?\?(\d);(\d)l)": self.ansi_unhandled,
-                r"\[;?(\d*)A": self.ansi_move_up,
-                r"\[;?(\d*)B": self.ansi_move_down,
-                r"\[;?(\d*)C": self.ansi_move_right,
-                r"\[;?(\d*)D": self.ansi_move_left,
-                r"\[;?(\d*)G": self.ansi_position_col,
-                r"\[;?(\d+);(\d+)H": self.ansi_position,
-                r"\[;?(\d+)H": self.ansi_position,
-                r"\[;?H": self.ansi_pos_home,
-                r"\[;?(\d*)J": self.ansi_erase,
-                r"\[;?(\d*)([XK])": self.ansi_erase_line,
-                r"\[;?(\d*)L": self.ansi_insert_lines,
-                r"\[;?(\d+)M": self.ansi_append_lines,
-                r"\[;?(\d*)P": self.ansi_delete_chars,
-                r"(\[;?(\d)S)": self.ansi_scroll_up,
-                r"\[;?(\d+)T": self.ansi_unhandled,  # CSI Ps T  Scroll down Ps lines (default = 1) (SD), VT420.
-                r"\[;?(\d+)@": self.insert_chars,  # CSI Ps @  Insert Ps (Blank) Character(s) (default = 1) (ICH).
-                r"M": self.ansi_move_up,   # https://www.aivosto.com/articles/control-characters.html
-                r"(c)": self.ansi_unhandled,  # Reset
-                r"(\]R)": self.ansi_unhandled,  # Reset Palette
-                r"\]0;([^\a]+)\a": self.xterm_set_window_title,
-                r"(\[;?>c)": self.ansi_secondary_device,
-                r"(\]1;([^\x07]+)\x07)": self.ansi_unhandled,  # set icon name
-                r"(\]2;([^\x07]+)\x07)": self.ansi_unhandled,  # set window title
-                r"(\]10;\?\x07)": self.ansi_unhandled,
-                r"(\]11;\?\x07)": self.ansi_unhandled,
-                r"(\]12;([^\x07]+)\x07)": self.ansi_unhandled,
-                r"(\[;?2(\d);(\d)t)": self.ansi_unhandled,     # Window manipulation (XTWINOPS)
-                r"(\[;?2(\d);(\d);(\d)t)": self.ansi_unhandled,
-                r"(\[;?>(\d);(\d?)m)": self.ansi_unhandled,
-                r"(=)": self.ansi_keypad,
-                r"(>)": self.ansi_keypad,
-                r"\((.)": self.ansi_charset,
-                r"(\](\d+)\x07)": self.ansi_unhandled,
-                r"(\[;?!p)": self.ansi_unhandled,
-                r"(\(0)": self.ansi_unhandled,
-        }
+    def input(self, data):
+        self.parser.feed(data)
+        self.schedule_refresh()
 
-        if self.remainder:
-            line = self.remainder + line
-            self.remainder = ""
+    def idle(self):
+        """True if not inside an escape sequence, so a dump() is a clean point to continue from"""
+        return self.parser.state == GROUND
 
-        while line:
-            parts = line.split(b"\033", 1)
-            if parts[0] != "":
-                try:
-                    self.puts(parts[0].decode(errors="replace"))
-                except Exception:
-                    self.log(f"err: puts {parts[0]}")
-                    self.log(traceback.format_exc())
+    def curses_attr(self, attr):
+        cattr = self.curses_attrs.get(attr)
+        if cattr is not None:
+            return cattr
 
-            if len(parts) == 1:
-                break
+        color_fg, color_bg, flags = unpack_attr(attr)
+        fg = 2  # green
+        bg = 0  # black
 
-            part = parts[1]
-            if part == "":
-                self.remainder = b"\033"
-                break
+        if color_fg != -1:
+            fg = color_fg
+        if color_bg != -1:
+            bg = color_bg
 
-            handled = False
-            for a in ansi:
-                try:
-                    # FIXME: precompile
-                    r = re.compile(fr"^{a}(.*)".encode(), re.DOTALL)
-                except Exception:
-                    self.log(f"todo: error compiling {a}")
-                    continue
-                m = r.match(part)
-                if m:
-                    g = m.groups()
-                    ansi[a]([x.decode() for x in g[:-1]])
-                    line = g[-1]
-                    handled = True
-                    break
-
-            if not handled:
-                if b"\033" not in part:
-                    self.remainder = b"\033" + part
-                    break
-                else:
-                    self.log(f"todo: unknown esc seq: {part}")
-                    line = part
+        if bg * 256 + fg not in self.colors:
+            idx = len(self.colors)
+            self.log(f"clr: adding {idx}: {fg} {bg}")
+            curses.init_pair(idx + 1, fg, bg)
+            self.colors[bg * 256 + fg] = idx
+        else:
+            idx = self.colors[bg * 256 + fg]
 
-    def input(self, data):
-        self.addansi(self.row, self.col, data)
-        self.refresh()
+        cattr = curses.color_pair(idx + 1)
+        for flag, curses_flag in CURSES_FLAGS:
+            if flags & flag:
+                cattr |= curses_flag
+        self.curses_attrs[attr] = cattr
+        return cattr
 
     def move_cursor(self, row, col):
-        if row >= self.rows or col >= self.cols:
-            curses.curs_set(0)
-        elif self.cursor_visible:
-            curses.curs_set(1)
+        visible = self.cursor_visible and row < self.rows and col < self.cols
+        if visible != self.cursor_shown:
+            curses.curs_set(1 if visible else 0)
+            self.cursor_shown = visible
 
         try:
             self.pad.move(row, col)
         except Exception:
             pass
 
+    def render(self):
+        if self.scroll_offset:
+            self.render_scrollback()
+            return
+        buffer = self.buffer
+        for row, (first, last) in buffer.dirty.items():
+            if row >= self.rows:
+                continue
+            line = buffer.line(row, first, last)
+            for start, end, attr in buffer.runs(row, first, last):
+                text = line[start - first:end - first]
+                try:
+                    self.pad.addstr(row, start, text, self.curses_attr(attr))
+                except Exception:
+                    self.log(f"err: {row} {start} {bytes(text.encode())}")
+        buffer.dirty.clear()
+        self.move_cursor(self.row, self.col)
+
+    def render_scrollback(self):
+        """the whole view while scrolled back: history lines followed by the top of the screen"""
+        history = len(self.scrollback)
+        for row in range(self.rows):
+            index = history - self.scroll_offset + row
+            if index < history:
+                chars, attrs = self.scrollback.line(index, self.cols)
+            else:
+                chars, attrs = self.buffer.chars[row - self.scroll_offset], self.buffer.attrs[row - self.scroll_offset]
+            line = chars.tobytes().decode("utf-32-le", errors="replace")
+            start = 0
+            for attr, cells in groupby(attrs):
+                end = start + sum(1 for _ in cells)
+                try:
+                    self.pad.addstr(row, start, line[start:end], self.curses_attr(attr))
+                except Exception:
+                    pass
+                start = end
+        self.buffer.touch_all()  # repainted from the buffer when leaving scroll mode
+        self.move_cursor(self.rows, self.cols)  # hidden
+
+    def schedule_refresh(self):
+        """coalesce refreshes: render at most once per loop iteration and not more often than fps"""
+        if not self.screen or self.refresh_handle:
+            return
+        loop = asyncio.get_event_loop()
+        delay = 0
+        if self.fps:
+            delay = self.last_refresh + 1 / self.fps - time.monotonic()
+        if delay > 0:
+            self.refresh_handle = loop.call_later(delay, self.scheduled_refresh)
+        else:
+            self.refresh_handle = loop.call_soon(self.scheduled_refresh)
+
+    def scheduled_refresh(self):
+        self.refresh_handle = None
+        self.refresh()
+
     def refresh(self):
-        self.screen.refresh()
+        if not self.screen:
+            return
+        if self.refresh_handle:
+            self.refresh_handle.cancel()
+            self.refresh_handle = None
+        self.last_refresh = time.monotonic()
+        self.render()
+        self.screen.noutrefresh()
         h = self.height - 2
         w = self.width - 2
         if h > self.rows:
@@ -912,10 +881,11 @@ class ClashTerminal:
         if w > self.cols:
             w = self.cols - 1
         try:
-            self.pad.refresh(0, 0, 0, 0, h, w)
+            self.pad.noutrefresh(0, 0, 0, 0, h, w)
         except Exception as exc:
             self.log(f"todo: err: pad.refresh")
             self.log(exc)
+        curses.doupdate()
 
     def resize(self, full=False, inner=True, rows=None, cols=None):
         if full:
@@ -923,7 +893,8 @@ class ClashTerminal:
             self.log(f"resize: screen {width}x{height}")
             self.height = height
             self.width = width
-            curses.resize_term(self.height, self.width)
+            if self.screen:
+                curses.resize_term(self.height, self.width)
             if inner:
                 self.cols = self.width - 1
                 self.rows = self.height - 1
@@ -934,14 +905,24 @@ class ClashTerminal:
             self.rows = rows
 
         if inner:
-            self.pad.resize(self.rows, self.cols)
-
-        self.screen.clear()
-        self.update_border()
-        self.refresh()
+            self.buffer.resize(self.cols, self.rows)
+            self.margin_top = 1
+            self.margin_bottom = self.rows
+            if self.pad:
+                self.pad.resize(self.rows, self.cols + 1)
+
+        if self.screen:
+            self.screen.clear()
+            self.update_border()
+            self.refresh()
         return self.width, self.height
 
-    def dump(self):
+    def dump(self, compact=False):
+        """
+        screen state, the cells packed into "snapshot" (base64) if compact, as
+        "lines" and "attrs" lists otherwise, along with the curses cells "dump"
+        and their color pairs "colors" peers from before the screen model restore
+        """
         msg = {"rows": self.rows,
                "cols": self.cols,
                "col": self.col,
@@ -949,38 +930,145 @@ class ClashTerminal:
                "color_fg": self.color_fg,
                "color_bg": self.color_bg,
                "color_flags": self.flags,
-               "dump": [],
-               "colors": self.colors}
-        for row in range(0, self.rows):
-            for col in range(0, self.cols):
-                c = self.pad.inch(row, col)
-                msg["dump"].append(c)
+               "bracketed_paste": self.dec_bracketed_paste_mode}
+        if compact:
+            msg["snapshot"] = base64.b64encode(self.buffer.snapshot()).decode()
+        else:
+            msg["lines"] = [self.buffer.line(row) for row in range(0, self.rows)]
+            msg["attrs"] = [self.buffer.attrs[row].tolist() for row in range(0, self.rows)]
+            msg["dump"], msg["colors"] = self.legacy_cells()
         return msg
 
+    def legacy_cells(self):
+        """the cells as curses characters (8 bit) with attributes and color pair, and the pairs' colors"""
+        colors = {}
+        cattrs = {}
+        cells = []
+        for row in range(self.rows):
+            for char, attr in zip(self.buffer.chars[row], self.buffer.attrs[row]):
+                cattr = cattrs.get(attr)
+                if cattr is None:
+                    fg, bg, flags = unpack_attr(attr)
+                    fg = 2 if fg == -1 else fg  # green on black, as curses_attr() shows the defaults
+                    bg = 0 if bg == -1 else bg
+                    idx = colors.setdefault(bg * 256 + fg, len(colors))
+                    cattr = ((idx + 1) << 8) & curses.A_COLOR
+                    for flag, curses_flag in CURSES_FLAGS:
+                        if flags & flag:
+                            cattr |= curses_flag
+                    cattrs[attr] = cattr
+                cells.append((char if char < 256 else ord("?")) | cattr)
+        return cells, colors
+
+    def load_legacy_cells(self, scrinit):
+        """restores the "dump" and "colors" of a peer from before the screen model"""
+        pairs = {idx + 1: (int(color) % 256, int(color) // 256) for color, idx in scrinit["colors"].items()}
+        attrs = {}
+        cols = scrinit["cols"]
+        cells = scrinit["dump"]
+        chars = []
+        rows = []
+        for row in range(scrinit["rows"]):
+            row_cells = cells[row * cols:(row + 1) * cols]
+            chars.append(array("I", [cell & curses.A_CHARTEXT for cell in row_cells]))
+            row_attrs = array("I")
+            for cell in row_cells:
+                attr = attrs.get(cell & ~curses.A_CHARTEXT)
+                if attr is None:
+                    fg, bg = pairs.get((cell & curses.A_COLOR) >> 8, (-1, -1))
+                    attr = attrs[cell & ~curses.A_CHARTEXT] = pack_attr(fg, bg, legacy_flags(cell))
+                row_attrs.append(attr)
+            rows.append(row_attrs)
+        self.buffer.load((chars, rows))
+
+    def state(self, base=None):
+        """
+        (payload, state) of the screen, cursor and modes since `base`, the state
+        of an earlier call, payload is None if nothing changed
+        """
+        screen, cursor = base or (None, None)
+        modes = ((STATE_CURSOR_VISIBLE if self.cursor_visible else 0)
+                 | (STATE_BRACKETED_PASTE if self.dec_bracketed_paste_mode else 0))
+        rows = self.buffer.changed(screen)
+        if not rows and cursor == (self.col, self.row, modes):
+            return None, base
+        payload = STATE.pack(self.col, self.row, modes) + self.buffer.diff(rows)
+        return payload, (self.buffer.save(), (self.col, self.row, modes))
+
+    def load_state(self, payload):
+        """applies a state() payload"""
+        col, row, modes = STATE.unpack_from(payload)
+        diff = payload[STATE.size:]
+        _, _, cols, rows, _, _ = DIFF_HEADER.unpack_from(diff)
+        if cols != self.cols or rows != self.rows:
+            self.resize(full=False, inner=True, cols=cols, rows=rows)
+        self.buffer.load_diff(diff)
+        self.col = col
+        self.row = row
+        self.cursor_visible = bool(modes & STATE_CURSOR_VISIBLE)
+        self.dec_bracketed_paste_mode = bool(modes & STATE_BRACKETED_PASTE)
+        self.refresh()
+
     def restore(self, scrinit):
-        for clr in scrinit["colors"]:
-            c = int(clr)
-            fg = c % 256
-            bg = (c - fg) // 256
-            curses.init_pair(scrinit["colors"][clr] + 1, fg, bg)
-
-        for r in range(0, scrinit['rows']):
-            for c in range(0, scrinit['cols']):
-                ch = scrinit['dump'][r * scrinit['cols'] + c]
-                try:
-                    self.pad.addch(r, c, ch)
-                except Exception as exc:
-                    self.log(f"todo: {exc} {r} {c} {ch}")
+        self.parser.reset()
+        self.flags = scrinit['color_flags']
+        if "snapshot" in scrinit:
+            self.buffer.load_snapshot(base64.b64decode(scrinit["snapshot"]))
+        elif "lines" in scrinit:
+            self.buffer.load_lines(scrinit["lines"], scrinit["attrs"])
+        else:
+            self.load_legacy_cells(scrinit)
+            self.flags = legacy_flags(self.flags)
 
         self.color_fg = scrinit['color_fg']
         self.color_bg = scrinit['color_bg']
-        self.color_flags = scrinit['color_flags']
+        self.dec_bracketed_paste_mode = scrinit.get("bracketed_paste", False)
         self.col = scrinit['col']
         self.row = scrinit['row']
         self.log(f"mov: {self.row}, {self.col}")
-        self.move_cursor(self.row, self.col)
         self.refresh()
 
+    def scroll_key(self, data):
+        """handles a key in scroll mode, returns False once scroll mode is left"""
+        key = SCROLL_KEYS.get(data)
+        if key == "quit":
+            self.scroll_mode(False)
+            return False
+        elif key == "up":
+            self.scroll_view(1)
+        elif key == "down":
+            self.scroll_view(-1)
+        elif key == "page up":
+            self.scroll_view(self.rows // 2)
+        elif key == "page down":
+            self.scroll_view(-(self.rows // 2))
+        elif key == "top":
+            self.scroll_view(len(self.scrollback))
+        elif key == "bottom":
+            self.scroll_view(-len(self.scrollback))
+        return True
+
+    def scroll_mode(self, on):
+        self.scrolling = on
+        self.scroll_offset = 0
+        self.buffer.touch_all()
+        self.update_border()
+        self.refresh()
+
+    def scroll_view(self, lines):
+        self.scroll_offset = max(0, min(self.scroll_offset + lines, len(self.scrollback)))
+        self.buffer.touch_all()
+        self.update_border()
+        self.refresh()
+
+    def set_status(self, status):
+        """short text shown in the border, left of the session id"""
+        if status == self.status:
+            return
+        self.status = status
+        self.update_border()
+        self.schedule_refresh()
+
     def set_title(self, title):
         self.title = title
         self.update_border()